@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# Copyright 2015 Paul Felt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks for the hot paths of broom and jobfarm. Results are printed and
+# may be saved as JSON (-o) and compared against an earlier run (-c).
+import time
+import json
+import sys
+import os
+import argparse
+import platform
+import tempfile
+import shutil
+import multiprocessing
+from broom import sweep, sweep_table, join, join_many, compile_join, Mapper, Range
+
+#################################
+# Support functions
+#################################
+def timed(f, repeat=3):
+    """ best wall time of repeat calls to f, and f's (last) result """
+    best = None
+    for r in range(repeat):
+        start = time.time()
+        result = f()
+        elapsed = time.time()-start
+        best = elapsed if best is None else min(best,elapsed)
+    return best, result
+
+def count(states):
+    n = 0
+    for item in states:
+        n += 1
+    return n
+
+def grid(dims, cardinality):
+    """ sweep() arguments for a static grid of dims keys with cardinality values each """
+    return ['command'] + [('--k%d'%d, Range(0,cardinality).generator) for d in range(dims)]
+
+def deep_size(obj, seen=None):
+    """ approximate memory (bytes) of an object and everything it references """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj,dict):
+        size += sum(deep_size(k,seen)+deep_size(v,seen) for k,v in obj.items())
+    elif isinstance(obj,(list,tuple,set)):
+        size += sum(deep_size(item,seen) for item in obj)
+    return size
+
+#################################
+# Benchmarks
+#################################
+def bench_sweep(quick):
+    """ sweep() enumeration rate versus number of dimensions and cardinality """
+    results = {}
+    for dims,cardinality in ((2,300),(4,16),(8,4),(16,2)) if not quick else ((2,100),(8,3)):
+        for copy in (True,False):
+            seconds,n = timed(lambda: count(sweep(*grid(dims,cardinality),copy=copy)))
+            results["dims=%d,card=%d,copy=%s"%(dims,cardinality,copy)] = {"states":n, "seconds":seconds, "states_per_second":n/seconds}
+    return results
+
+def bench_mapper(quick):
+    """ dependent sweeps dominated by Mapper lookups """
+    datasets = ['data%d'%i for i in range(50)]
+    mapping = dict(('data%d$'%i,(i,i+1)) for i in range(50))
+    size = 200 if not quick else 20
+    def run():
+        return count(sweep(
+            ('--dataset',datasets),
+            ('--seed',Range(0,size).generator),
+            ('--size',Mapper('--dataset',mapping).generator),
+            ('--other',Mapper('--dataset',mapping,default=0).generator),
+        ))
+    seconds,n = timed(run)
+    return {"states":n, "seconds":seconds, "states_per_second":n/seconds}
+
+def bench_join(quick):
+    """ join() versus compile_join()/join_many() on the same states """
+    things = grid(5,6 if not quick else 4)
+    states = [state for keys,state in sweep(*things)]
+    keys = list(sweep(*things))[0][0]
+    table = sweep_table(*things)
+    compiled = compile_join(keys)
+    results = {}
+    for name,f in (("join",lambda: [join(keys,state) for state in states]),
+                   ("compile_join",lambda: [compiled(state) for state in states]),
+                   ("join_many",lambda: join_many(keys,states)),
+                   ("join_many_table",lambda: join_many(keys,table))):
+        seconds,out = timed(f)
+        results[name] = {"strings":len(out), "seconds":seconds, "strings_per_second":len(out)/seconds}
+    return results
+
+def bench_memory(quick):
+    """ bytes per state: one dict per state versus sweep_table() columns """
+    things = grid(6,6 if not quick else 4)
+    states = [state for keys,state in sweep(*things)]
+    dict_bytes = deep_size(states)
+    table = sweep_table(*things)
+    table_bytes = sum(col.buffer_info()[1]*col.itemsize for col in table.codes.values()) + deep_size(table.values)
+    return {"states":len(states), "dict_bytes_per_state":float(dict_bytes)/len(states),
+            "table_bytes_per_state":float(table_bytes)/len(table)}
+
+def run_farm(jobs, slots, outdir):
+    os.setsid() # farm_jobs ends by killing its process group
+    import jobfarm
+    jobfarm.farm_jobs(jobs, None, outdir=outdir, local=True, local_slots=slots, metrics_interval=3600)
+
+FARM_DURATIONS = (0,0.05) # seconds each simulated job sleeps (--durations)
+
+def bench_farm(quick):
+    """ end-to-end farm_jobs throughput on this machine for simulated job durations """
+    results = {}
+    numjobs = 200 if not quick else 40
+    for duration in FARM_DURATIONS:
+        jobs = ["sleep %s"%duration for i in range(numjobs)]
+        outdir = tempfile.mkdtemp()
+        try:
+            farm = multiprocessing.Process(target=run_farm, args=(jobs,4,os.path.join(outdir,'farm')))
+            start = time.time()
+            farm.start()
+            farm.join()
+            seconds = time.time()-start
+        finally:
+            shutil.rmtree(outdir)
+        results["duration=%s,slots=4"%duration] = {"jobs":numjobs, "seconds":seconds, "jobs_per_second":numjobs/seconds,
+                                                    "ideal_jobs_per_second":4/duration if duration else None}
+    return results
+
+BENCHMARKS = [
+    ("sweep", bench_sweep),
+    ("mapper", bench_mapper),
+    ("join", bench_join),
+    ("memory", bench_memory),
+    ("farm", bench_farm),
+]
+
+def compare(results, baseline):
+    """ prints the ratio of each rate (and size) to the same figure in baseline """
+    for name,result in sorted(flatten(results).items()):
+        old = flatten(baseline["results"]).get(name)
+        if old and result and isinstance(result,(int,float)) and (name.endswith("per_second") or name.endswith("per_state")):
+            print("%-60s %12.1f  (%.2fx baseline)" % (name,result,float(result)/old))
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key,val in results.items():
+        if isinstance(val,dict):
+            flat.update(flatten(val,prefix+key+"/"))
+        else:
+            flat[prefix+key] = val
+    return flat
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Benchmarks for broom and jobfarm")
+    parser.add_argument("benchmarks",nargs='*',help="which benchmarks to run (default all): %s"%(", ".join(name for name,f in BENCHMARKS)))
+    parser.add_argument("-q","--quick",default=False,action='store_true',help="smaller problem sizes")
+    parser.add_argument("-o","--output",help="save results to this JSON file")
+    parser.add_argument("-c","--compare",help="compare against results saved earlier with -o")
+    parser.add_argument("-d","--durations",type=float,nargs='+',help="simulated job durations (seconds) for the farm benchmark")
+    args = parser.parse_args()
+    if args.durations is not None:
+        FARM_DURATIONS = args.durations
+
+    results = {}
+    for name,f in BENCHMARKS:
+        if not args.benchmarks or name in args.benchmarks:
+            results[name] = f(args.quick)
+            for key,val in sorted(flatten(results[name]).items()):
+                print("%s/%s: %s" % (name,key,val))
+    record = {"time":time.time(), "python":platform.python_version(), "machine":platform.node(), "quick":args.quick, "results":results}
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(record,f,indent=1,sort_keys=True)
+    if args.compare is not None:
+        compare(results, json.load(open(args.compare)))
@@ -13,27 +13,178 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import re
+import array
+import itertools
+import bisect
+import collections
+import multiprocessing
+import random
+import traceback
 
 #################################
 # Support functions
 #################################
-def cartesian_product(keys,state,entries):
+# marks a key that was not in the state before a depth assigned it
+_UNBOUND = object()
+
+def visible_keys(keys,state,entries):
+    ''' The keys available to the value generator at each depth of a product 
+        over entries starting from state. These only depend on the depth, 
+        so they are found once rather than for every node.
+    '''
+    bound = set(state.keys())
+    keys_in_state = []
+    for key,f in entries:
+        keys_in_state.append([k for k in keys if k in bound])
+        bound.add(key)
+    return keys_in_state
+
+def cartesian_product(keys,state,entries,copy=True):
+    ''' Iterates over the cartesian product of entries (key,function pairs) 
+        without recursion. A single working state is mutated in place as 
+        the product is walked depth by depth; value generators see exactly 
+        the keys they would see if every depth had its own copy.
+
+        If copy is False, the working state itself is yielded, so it is only 
+        valid until the next item is requested. Otherwise each item is a 
+        fresh dict.
+    '''
+    state = state.copy() # working state (mutated in place)
+    keys_in_state = visible_keys(keys,state,entries)
     # base case
     if len(entries)==0:
-        yield state
-    # recurse
-    else:
-        # copy state (so that we don't get weird mutation things happening)
-        state = state.copy()
-        keys_in_state = [k for k in keys if k in state.keys()]
-        # each entry has a state key and a function that produces a value generator
-        key,f = entries[0]
-        value_generator = f(keys_in_state,state)
-        # iterate over each value for the outermost key, recurse on the remainder
-        for val in value_generator:
+        yield state.copy() if copy else state
+        return
+    last = len(entries)-1
+    generators = [None]*len(entries) # value generator at each depth
+    shadowed = [None]*len(entries) # value (if any) each depth's key overwrote
+    depth = 0
+    key,f = entries[0]
+    shadowed[0] = state.get(key,_UNBOUND)
+    generators[0] = iter(f(keys_in_state[0],state))
+    while depth>=0:
+        key = entries[depth][0]
+        if depth==last:
+            # innermost loop: nothing to descend into
+            for val in generators[depth]:
+                state[key] = val
+                yield state.copy() if copy else state
+            val = _UNBOUND
+        else:
+            val = next(generators[depth],_UNBOUND)
+        if val is _UNBOUND:
+            # generator exhausted: undo this depth's assignment and back up
+            if shadowed[depth] is _UNBOUND:
+                state.pop(key,None)
+            else:
+                state[key] = shadowed[depth]
+            generators[depth] = None
+            depth -= 1
+        else:
+            # descend to the next depth
             state[key] = val
-            for inner_state in cartesian_product(keys,state,entries[1:]):
-                yield inner_state
+            depth += 1
+            key,f = entries[depth]
+            shadowed[depth] = state.get(key,_UNBOUND)
+            generators[depth] = iter(f(keys_in_state[depth],state))
+
+# states per message sent back by a parallel_product() worker
+CHUNK_SIZE = 1000
+
+def shard_worker(keys,entries,tasks,results,index,chunksize):
+    ''' Enumerates the states under each prefix taken from tasks (until None) 
+        and sends them to results as (index,states,done,error) chunks '''
+    for prefix in iter(tasks.get,None):
+        try:
+            chunk = []
+            for state in cartesian_product(keys,prefix,entries):
+                chunk.append(state)
+                if len(chunk)>=chunksize:
+                    results.put((index,chunk,False,None)) # waits while the results are not being read
+                    chunk = []
+            results.put((index,chunk,True,None))
+        except Exception:
+            results.put((index,None,True,traceback.format_exc()))
+            return
+
+def extend_prefixes(keys,prefixes,entry):
+    ''' The states one entry deeper under each of prefixes, in order. '''
+    for prefix in prefixes:
+        for state in cartesian_product(keys,prefix,[entry]):
+            yield state
+
+def parallel_product(keys,entries,workers,ordered=True,chunksize=CHUNK_SIZE):
+    ''' Like cartesian_product(keys,{},entries), but enumerated by worker 
+        processes. The prefixes of the product (values for the first few 
+        entries) are enumerated here, going deeper until there are enough 
+        of them to keep the workers busy, and each worker enumerates the 
+        states under one prefix at a time and streams them back in chunks 
+        of chunksize.
+
+        Only about 2*workers prefixes are handed out at a time, and a worker 
+        waits while its chunks are not being read, so memory stays bounded 
+        however slowly the states are consumed.
+
+        If ordered is False, chunks are yielded as soon as they are done.
+
+        Notes:
+            - Workers are forked, so generator functions need not be 
+              picklable, but values must be.
+            - Counters updated inside the workers (e.g. Memoized.hits or 
+              Where.pruned) are not reflected in this process.
+    '''
+    split = 1
+    prefixes = cartesian_product(keys,{},entries[:split])
+    buffered = list(itertools.islice(prefixes,4*workers))
+    while len(buffered)<4*workers and split<len(entries)-1:
+        # too few to keep the workers busy: go one entry deeper under each
+        prefixes = extend_prefixes(keys,buffered,entries[split])
+        split += 1
+        buffered = list(itertools.islice(prefixes,4*workers))
+    prefixes = itertools.chain(buffered,prefixes)
+    # fork so that workers inherit the generator functions
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing,'get_context') else multiprocessing
+    tasks = [context.Queue() for w in range(workers)]
+    if ordered:
+        # a queue per worker, so that only the worker whose chunks come next is read
+        results = [context.Queue(2) for w in range(workers)]
+    else:
+        results = [context.Queue(2*workers)]*workers
+    procs = [context.Process(target=shard_worker,args=(keys,entries[split:],tasks[w],results[w],w,chunksize)) for w in range(workers)]
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+    try:
+        pending = collections.deque() # the worker of each prefix handed out, in order
+        def hand_out(w):
+            for prefix in itertools.islice(prefixes,1):
+                tasks[w].put(prefix)
+                pending.append(w)
+        for w in range(2*workers):
+            hand_out(w%workers)
+        nextworker = 0 # (ordered) prefixes go round-robin
+        while pending:
+            index,chunk,done,error = results[pending[0]].get()
+            if error is not None:
+                raise Exception("parallel_product() worker failed:\n%s"%error)
+            for state in chunk:
+                yield state
+            if done:
+                if ordered:
+                    pending.popleft()
+                    hand_out(nextworker)
+                    nextworker = (nextworker+1)%workers
+                else:
+                    pending.remove(index)
+                    hand_out(index)
+        for w in range(workers):
+            tasks[w].put(None)
+        for proc in procs:
+            proc.join()
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
 
 # static generators that don't depend on state
 class ConstantGenerator:
@@ -49,6 +200,26 @@ class ListGenerator:
         for item in self.lst:
             yield item
 
+class PrunedGenerator:
+    def __init__(self,key,valuegen,predicates):
+        self.key = key
+        self.valuegen = valuegen
+        self.predicates = predicates
+    def genmaker(self,keys,state):
+        for val in self.valuegen(keys,state):
+            state[self.key] = val # the state seen by predicates includes this value
+            if all(where.test(state) for where in self.predicates):
+                yield val
+
+# a Sweep passed as an argument stands for its own arguments
+def flatten_sweeps(things):
+    for thing in things:
+        if isinstance(thing,Sweep):
+            for inner in flatten_sweeps(thing.things):
+                yield inner
+        else:
+            yield thing
+
 # keys for constant things that only have a value
 def keygenerator():
     i=0
@@ -56,46 +227,27 @@ def keygenerator():
         i+=1
         yield i
 
-#################################
-# Main API function
-#################################
-def sweep(*things):
-    ''' Takes a list of arguments, each of which must be either
-        1) a constant
-        2) a key-value pair 
-            where the key can be made a string by str()
-            and the value is either 
-            1) a constant value
-            2) a list (or similar) over items that can be made strings by str()
-            3) a function that returns a generator over values given 'state', a 
-                map containing values for all key-value pairs that appear previous 
-                to this pair in the list of arguments. This allows values to 
-                depend on (be constrained by) other parts of the state, making 
-                this iterator slightly smarter than a naive cartesian product 
-                over sets.
-        3) None: these values are ignored
-
-        Yields all possible pairs of keys,state where 'keys' encodes the original ordering 
-        of arguments, and 'state' is a map containing a value for each key. 
-        int value keys are generated automaticaly for constant arguments.
-
-        Each keys,state pair may be converted into a string by join(keys,state)
+def sweep_entries(things):
+    ''' Normalizes the arguments of sweep() into keys (the original ordering, 
+        as yielded by sweep()) and entries (state key, value generator function) 
     '''
-
     # convert everything into key-value pairs
     # singleton things get assigned a unique numerical key
     keygen = keygenerator()
     keys = [] # track key order 
     pairs = []
-    for thing in things:
+    wheres = []
+    for thing in flatten_sweeps(things):
         if thing is not None: # ignore Nones
-            if isinstance(thing,(list,tuple)):
+            if isinstance(thing,Where):
+                wheres.append(thing)
+            elif isinstance(thing,(list,tuple)):
                 keys.append(str(thing[0])) # key is str
                 pairs.append((thing[0],thing[1]))
                 if len(thing)!=2:
                     raise Exception("Everything passed to sweep() must be constants or else key-value pairs (length==2)\n\tBad argument:%s"%str(thing))
             else:
-                key = keygen.next() # key is int
+                key = next(keygen) # key is int
                 keys.append(key)
                 pairs.append((key,thing))
 
@@ -114,8 +266,78 @@ def sweep(*things):
         else:
             entries.append((key,ConstantGenerator(val).genmaker))
 
+    # push each constraint down to the earliest entry that binds all its keys
+    predicates = [[] for entry in entries]
+    entrykeys = [key for key,f in entries]
+    for where in wheres:
+        depth = 0
+        for key in where.keys:
+            if key not in entrykeys:
+                raise Exception("Where() depends on %s, which is not a key in the sweep"%str(key))
+            depth = max(depth,entrykeys.index(key))
+        if entries:
+            predicates[depth].append(where)
+    for depth,(key,f) in enumerate(entries):
+        if predicates[depth]:
+            entries[depth] = (key,PrunedGenerator(key,f,predicates[depth]).genmaker)
+
+    return keys,entries
+
+#################################
+# Main API function
+#################################
+def sweep(*things,**kwargs):
+    ''' Takes a list of arguments, each of which must be either
+        1) a constant
+        2) a key-value pair 
+            where the key can be made a string by str()
+            and the value is either 
+            1) a constant value
+            2) a list (or similar) over items that can be made strings by str()
+            3) a function that returns a generator over values given 'state', a 
+                map containing values for all key-value pairs that appear previous 
+                to this pair in the list of arguments. This allows values to 
+                depend on (be constrained by) other parts of the state, making 
+                this iterator slightly smarter than a naive cartesian product 
+                over sets.
+        3) None: these values are ignored
+        4) a Where constraint, which removes combinations of values as early 
+            as possible (see Where)
+        5) a Sweep, whose arguments are spliced in where it appears (a nested 
+            sub-sweep; see also Product)
+
+        Yields all possible pairs of keys,state where 'keys' encodes the original ordering 
+        of arguments, and 'state' is a map containing a value for each key. 
+        int value keys are generated automaticaly for constant arguments.
+
+        Each keys,state pair may be converted into a string by join(keys,state)
+
+        Keyword arguments:
+            copy (default True): if False, the same state dict is yielded 
+                every time (updated in place), which is faster but means the 
+                caller must copy any state it wants to keep.
+            workers (default None): if greater than 1, the product is split 
+                into subtrees under the first few entries, which are 
+                enumerated by this many processes (see 
+                parallel_product). Worth it when generator functions are 
+                expensive.
+            ordered (default True): with workers, whether states must come 
+                out in the usual order or may come out in any order.
+    '''
+    copy = kwargs.pop('copy',True)
+    workers = kwargs.pop('workers',None)
+    ordered = kwargs.pop('ordered',True)
+    if kwargs:
+        raise Exception("Unexpected keyword arguments to sweep(): %s"%(', '.join(kwargs.keys())))
+
+    keys,entries = sweep_entries(things)
+
     # cartesian product over states
-    for state in cartesian_product(keys,{},entries):
+    if workers is not None and workers>1 and len(entries)>1:
+        states = parallel_product(keys,entries,workers,ordered)
+    else:
+        states = cartesian_product(keys,{},entries,copy=copy)
+    for state in states:
         yield keys,state
 
 def join(keys,state,delim=' ',equals='='):
@@ -149,6 +371,130 @@ def join(keys,state,delim=' ',equals='='):
     # option strings -> command string
     return delim.join(optlist)
 
+def compile_join(keys,delim=' ',equals='=',maxcache=10000):
+    '''
+    Returns a function f(state) equivalent to join(keys,state,delim,equals) 
+    for a fixed ordering of keys. The decisions that only depend on the keys 
+    are made once here, and the option string rendered for each (key,value) 
+    is cached (up to maxcache values per key) so repeated values are not 
+    converted with str() again. Only strings, numbers, booleans and None 
+    are cached, since other values may be equal but print differently.
+    '''
+    options = [(key,renderer.cache,renderer.render) for key,renderer in 
+                ((key,OptionRenderer(key,equals,maxcache)) for key in keys)]
+    def compiled_join(state):
+        optlist = []
+        for key,cache,render in options:
+            val = state[key]
+            try: # inline cache hit (the common case)
+                opt = cache[(val.__class__,val)]
+            except (KeyError,TypeError):
+                opt = render(val)
+            if opt is not None:
+                optlist.append(opt)
+        return delim.join(optlist)
+    return compiled_join
+
+# types whose equal values (of the same type) always print the same, so 
+# their option strings may be cached by value
+CACHED_TYPES = set([str,int,float,bool,type(None)])
+try:
+    CACHED_TYPES.update([unicode,long]) # python2
+except NameError:
+    pass
+
+class OptionRenderer:
+    ''' Renders (and caches) the option string for one key of join() '''
+    def __init__(self,key,equals,maxcache):
+        self.key = key
+        self.prefix = None if isinstance(key,int) else key+equals
+        self.maxcache = maxcache
+        self.cache = {}
+    def render_uncached(self,val):
+        if val is None:
+            return None
+        val = str(val)
+        # 'val' (auto-key)
+        if self.prefix is None:
+            return val
+        # 'key' (empty string values)
+        elif len(val)==0:
+            return self.key
+        # 'key=value' (normal key-val pair)
+        return self.prefix+val
+    def render(self,val):
+        # include the type since e.g. 1, 1.0 and True are equal but print differently
+        cachekey = (val.__class__,val)
+        try:
+            return self.cache[cachekey]
+        except (KeyError,TypeError): # not cached (or unhashable)
+            opt = self.render_uncached(val)
+            # only values that print the same as every value equal to them 
+            # (not e.g. (1.0,) vs (1,), Decimal('1.00') vs Decimal('1.0'), 0.0 vs -0.0)
+            if val.__class__ in CACHED_TYPES and not (val.__class__ is float and val==0) and len(self.cache)<self.maxcache:
+                self.cache[cachekey] = opt
+            return opt
+
+def join_many(keys,states,delim=' ',equals='='):
+    '''
+    Returns [join(keys,state,delim,equals) for state in states], sharing 
+    the work between states (see compile_join). states may also be a 
+    SweepTable, in which case each distinct value of each column is 
+    rendered only once.
+    '''
+    if isinstance(states,SweepTable):
+        columns = []
+        for key in keys:
+            renderer = OptionRenderer(key,equals,0)
+            rendered = [renderer.render_uncached(val) for val in states.values[key]]
+            columns.append((rendered,states.codes[key]))
+        return [delim.join(opt for opt in (rendered[codes[i]] for rendered,codes in columns) if opt is not None)
+                for i in range(len(states))]
+    compiled_join = compile_join(keys,delim,equals)
+    return [compiled_join(state) for state in states]
+
+class Memoized():
+    '''
+    Wraps a generator function whose values only depend on a few keys 
+    of the state (depends), so that its values are computed once per 
+    distinct combination of those keys and replayed afterwards. At most 
+    maxsize value lists are kept (least recently used are dropped). 
+    Usage:
+    sweep(
+        ('--a',('zero','one')),
+        ('--b',Memoized(CustomValues('custom').generator,('--a',)).generator),
+    )
+
+    Notes:
+        - hits and misses count how often cached values were replayed 
+          or had to be computed.
+        - States whose depends values are unhashable are never cached.
+    '''
+    def __init__(self,valuegen,depends,maxsize=1024):
+        self.valuegen=valuegen
+        self.depends=tuple(depends)
+        self.maxsize=maxsize
+        self.cache=collections.OrderedDict()
+        self.hits=0
+        self.misses=0
+    def generator(self,keys,state):
+        cachekey = tuple(state.get(k) for k in self.depends)
+        try:
+            values = self.cache.pop(cachekey) # re-inserted below as most recent
+            self.hits += 1
+        except KeyError:
+            values = list(self.valuegen(keys,state))
+            self.misses += 1
+            if self.maxsize<=0:
+                return iter(values)
+            if len(self.cache)>=self.maxsize:
+                self.cache.popitem(last=False)
+        except TypeError: # unhashable
+            self.misses += 1
+            return iter(list(self.valuegen(keys,state)))
+        self.cache[cachekey] = values
+        return iter(values)
+
 class Mapper():
     '''
     A convenience generator that uses a dict to impose a 
@@ -168,23 +514,29 @@ class Mapper():
         - If multiple patterns match, an error is raised.
         - The default value (if specified) is returned when nothing is matched.
     '''
-    def __init__(self,statekey,valmapping,default=None):
+    def __init__(self,statekey,valmapping,default=None,maxsize=1024):
         self.statekey=statekey
         self.valmapping=valmapping
         self.default=default
+        # compile patterns once rather than on every state
+        self.patterns = []
+        for mapkey,mapval in valmapping.items():
+            assert isinstance(mapkey,str), "the mapping key %s is not a string but rather a %s"%(mapkey,str(type(mapkey)))
+            self.patterns.append((re.compile(mapkey),mapval))
+        # the same state values come up over and over, so remember their mappings
+        self.cache = Memoized(self.values,(statekey,),maxsize)
     def list_yield(self,thing):
         if isinstance(thing,(list,tuple)):
             for item in thing:
                 yield item
         else:
             yield thing
-    def generator(self,keys,state):
+    def values(self,keys,state):
         stateval = state[self.statekey]
         # yield all mappings that contain substrings of the state value
         didyield = False
-        for mapkey,mapval in self.valmapping.items():
-            assert isinstance(mapkey,str), "the mapping key %s is not a string but rather a %s"%(mapkey,str(type(mapkey)))
-            if stateval is not None and re.match(mapkey,stateval):
+        for pattern,mapval in self.patterns:
+            if stateval is not None and pattern.match(stateval):
                 assert not didyield, "multiple keys matched the value %s for Mapper(%s) matched multiple values"%(stateval,self.statekey)
                 for yld in self.list_yield(mapval):
                     yield yld
@@ -194,6 +546,8 @@ class Mapper():
         if not didyield:
             for yld in self.list_yield(self.default):
                 yield yld
+    def generator(self,keys,state):
+        return self.cache.generator(keys,state)
 
 class Range():
     ''''
@@ -209,6 +563,38 @@ class Range():
         for r in range(self.start,self.end):
             yield r
 
+class Where():
+    '''
+    A constraint on the states produced by sweep(). predicate is called 
+    with the state and should return False for combinations that are not 
+    wanted. keys names the state keys predicate reads; it is checked as 
+    soon as all of them have values, so the rest of the product under a 
+    rejected combination is never generated. Usage:
+    sweep(
+        ('--a',Range(0,100).generator),
+        ('--b',Range(0,100).generator),
+        Where(lambda state: state['--a']<state['--b'], '--a','--b'),
+        ('--c',('x','y','z')),
+    )
+
+    Notes:
+        - tested and pruned count how often the predicate was checked 
+          and how often it rejected a combination.
+    '''
+    def __init__(self,predicate,*keys):
+        self.predicate=predicate
+        self.keys=keys
+        self.tested=0
+        self.pruned=0
+    def test(self,state):
+        self.tested += 1
+        if self.predicate(state):
+            return True
+        self.pruned += 1
+        return False
+    def __str__(self):
+        return "Where(%s): pruned %d/%d" % (','.join(str(k) for k in self.keys),self.pruned,self.tested)
+
 def shorten_option(option,maxlength=5):
     '''
     Expects a standard option string ('--some-long-option'). 
@@ -231,6 +617,473 @@ def shorten_option(option,maxlength=5):
         cumlength += len(bit)
     return ''.join(short)
 
+#################################
+# Columnar sweeps
+#################################
+def static_values(f):
+    ''' Returns the list of values produced by a value generator function if 
+        they are known not to depend on the state (constants, lists, Range), 
+        otherwise None.
+    '''
+    owner = getattr(f,'__self__',None)
+    if isinstance(owner,ConstantGenerator):
+        return [owner.val]
+    if isinstance(owner,ListGenerator):
+        return list(owner.lst)
+    if isinstance(owner,Range) and f.__name__=='generator':
+        return list(range(owner.start,owner.end))
+    return None
+
+def code_array(codes,numvalues):
+    ''' Packs value codes into the smallest array type that can hold them '''
+    typecode = 'B' if numvalues<=0xff else 'H' if numvalues<=0xffff else 'L'
+    return array.array(typecode,codes)
+
+def repeat_each(codes,counts,numvalues):
+    ''' Repeats codes[i] counts[i] times (counts may be a single int) '''
+    if isinstance(counts,int):
+        if counts==1:
+            return codes
+        repeated = itertools.chain.from_iterable(itertools.repeat(c,counts) for c in codes)
+    else:
+        repeated = itertools.chain.from_iterable(itertools.repeat(c,n) for c,n in zip(codes,counts))
+    return code_array(repeated,numvalues)
+
+def select_rows(codes,rows):
+    ''' Keeps only the given rows of every column of codes '''
+    selected = {}
+    for key,col in codes.items():
+        selected[key] = array.array(col.typecode,(col[i] for i in rows))
+    return selected
+
+class SweepTable():
+    '''
+    The result of sweep_table(): every state that sweep() would yield, 
+    stored by column rather than as one dict per state. Each column is 
+    an array of codes indexing into that column's list of values, so 
+    filtering and counting only need to look at each distinct value once.
+
+    Iterating over a SweepTable yields keys,state pairs just like sweep().
+    '''
+    def __init__(self,keys,statekeys,values,codes,numrows):
+        self.keys = keys # same ordering as yielded by sweep()
+        self.statekeys = statekeys # state keys, one per column
+        self.values = values # state key -> list of values
+        self.codes = codes # state key -> array of indices into values
+        self.numrows = numrows
+    def __len__(self):
+        return self.numrows
+    def column(self,key):
+        ''' All values of key, one per row '''
+        values = self.values[key]
+        return [values[c] for c in self.codes[key]]
+    def row(self,i):
+        ''' The state for row i '''
+        if i<0:
+            i += self.numrows
+        return dict((key,self.values[key][self.codes[key][i]]) for key in self.statekeys)
+    def __iter__(self):
+        for i in range(self.numrows):
+            yield self.keys,self.row(i)
+    def matches(self,key,test):
+        ''' A per-value lookup table of test() for column key '''
+        return [bool(test(val)) for val in self.values[key]]
+    def count(self,key,test):
+        ''' The number of rows whose value for key passes test '''
+        matches = self.matches(key,test)
+        return sum(1 for c in self.codes[key] if matches[c])
+    def where(self,key,test):
+        ''' A new SweepTable containing only rows whose value for key passes test '''
+        matches = self.matches(key,test)
+        rows = [i for i,c in enumerate(self.codes[key]) if matches[c]]
+        return SweepTable(self.keys,self.statekeys,self.values,select_rows(self.codes,rows),len(rows))
+
+class CountNode():
+    ''' One prefix of a Sweep with a dependent entry: the values at this 
+        depth and the number of states below each of them '''
+    def __init__(self,values,cumcounts,children):
+        self.values = values
+        self.cumcounts = cumcounts # cumcounts[j] = number of states below values[:j+1]
+        self.children = children # None when everything below is static
+    def count(self):
+        return self.cumcounts[-1] if self.cumcounts else 0
+
+class Sweep():
+    '''
+    A sweep() that can also be counted and indexed without enumerating it. 
+    Takes the same arguments as sweep(); iterating yields the same keys,state 
+    pairs in the same order.
+
+    len(s), s[i], and s[i:j:k] decode an index directly into a state by 
+    mixed-radix arithmetic when the values are constants, lists, or Range. 
+    If some values come from other generator functions, the states under 
+    those entries are counted once (per prefix) and the counts are cached.
+    '''
+    def __init__(self,*things,**kwargs):
+        self.copy = kwargs.pop('copy',True)
+        if kwargs:
+            raise Exception("Unexpected keyword arguments to Sweep(): %s"%(', '.join(kwargs.keys())))
+        self.things = things
+        self.keys,self.entries = sweep_entries(things)
+        self.keys_in_state = visible_keys(self.keys,{},self.entries)
+        self.static = [static_values(f) for key,f in self.entries]
+        # number of states below each depth when everything below is static (else None)
+        self.suffix_sizes = [1]
+        for vals in reversed(self.static):
+            below = self.suffix_sizes[0]
+            self.suffix_sizes.insert(0, None if vals is None or below is None else len(vals)*below)
+        self.root = None # count tree (built on demand)
+    def __iter__(self):
+        for state in cartesian_product(self.keys,{},self.entries,copy=self.copy):
+            yield self.keys,state
+    def count_tree(self):
+        if self.root is None:
+            self.root = self.expand(0,{})
+        return self.root
+    def expand(self,depth,prefix):
+        ''' Builds the CountNode for the state prefix at depth '''
+        key,f = self.entries[depth]
+        state = prefix.copy()
+        values = []
+        for val in f(self.keys_in_state[depth],state):
+            state[key] = val
+            values.append(val)
+        cumcounts = []
+        children = None
+        total = 0
+        if self.suffix_sizes[depth+1] is not None:
+            for val in values:
+                total += self.suffix_sizes[depth+1]
+                cumcounts.append(total)
+        else:
+            children = []
+            for val in values:
+                state = prefix.copy()
+                state[key] = val
+                child = self.expand(depth+1,state)
+                children.append(child)
+                total += child.count()
+                cumcounts.append(total)
+        return CountNode(values,cumcounts,children)
+    def size(self):
+        ''' The number of states (like len(), but not limited to sys.maxsize) '''
+        if self.suffix_sizes[0] is not None:
+            return self.suffix_sizes[0]
+        return self.count_tree().count()
+    def __len__(self):
+        return self.size()
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return list(self.islice(*i.indices(len(self))))
+        size = self.size()
+        if i<0:
+            i += size
+        if not 0<=i<size:
+            raise IndexError("Sweep index out of range")
+        state = {}
+        node = None if self.suffix_sizes[0] is not None else self.count_tree()
+        for depth,(key,f) in enumerate(self.entries):
+            if self.suffix_sizes[depth] is not None:
+                # static from here on: mixed-radix digits
+                stride = self.suffix_sizes[depth+1]
+                state[key] = self.static[depth][i//stride]
+                i %= stride
+            else:
+                j = bisect.bisect_right(node.cumcounts,i)
+                if j>0:
+                    i -= node.cumcounts[j-1]
+                state[key] = node.values[j]
+                node = node.children[j] if node.children is not None else None
+        return self.keys,state
+    def islice(self,start=0,stop=None,step=1):
+        ''' Lazily yields the states from index start (inclusive) to stop 
+            (exclusive), e.g. to resume a sweep or to take every n-th state '''
+        if stop is None:
+            stop = self.size()
+        i = start
+        while i<stop:
+            yield self[i]
+            i += step
+
+def sweep_table(*things):
+    ''' Takes the same arguments as sweep() and returns a SweepTable holding 
+        all of its states in columnar form. 
+
+        Every value must be a constant, a list, a Range, or a Mapper. Static 
+        values are laid out by index arithmetic; a Mapper is evaluated once 
+        per distinct value of the key it reads and the result is broadcast 
+        to every row with that value. Other generator functions may depend 
+        on the whole state and are not supported (use sweep() instead).
+    '''
+    keys,entries = sweep_entries(things)
+    statekeys = []
+    values = {}
+    codes = {}
+    numrows = 1
+    for key,f in entries:
+        if key in codes:
+            raise Exception("sweep_table() does not support repeated keys: %s"%str(key))
+        predicates = []
+        if isinstance(getattr(f,'__self__',None),PrunedGenerator):
+            predicates = f.__self__.predicates
+            f = f.__self__.valuegen
+        vals = static_values(f)
+        owner = getattr(f,'__self__',None)
+        if vals is not None:
+            # independent: every existing row expands into len(vals) rows
+            n = len(vals)
+            for k in statekeys:
+                codes[k] = repeat_each(codes[k],n,len(values[k]))
+            block = code_array(range(n),n)
+            codes[key] = block*numrows
+            numrows *= n
+        elif isinstance(owner,Mapper):
+            # dependent on a single earlier key: evaluate once per parent value
+            if owner.statekey not in codes:
+                raise Exception("Mapper(%s) must come after the key it reads"%str(owner.statekey))
+            keys_in_state = [k for k in keys if k in codes]
+            vals = []
+            mapped = [] # parent code -> codes of mapped values
+            for parentval in values[owner.statekey]:
+                mappedvals = list(f(keys_in_state,{owner.statekey:parentval}))
+                mapped.append(list(range(len(vals),len(vals)+len(mappedvals))))
+                vals.extend(mappedvals)
+            parentcodes = codes[owner.statekey]
+            if all(len(m)==1 for m in mapped):
+                # broadcast: one value per row
+                codes[key] = code_array((mapped[c][0] for c in parentcodes),len(vals))
+            else:
+                counts = [len(mapped[c]) for c in parentcodes]
+                for k in statekeys:
+                    codes[k] = repeat_each(codes[k],counts,len(values[k]))
+                codes[key] = code_array(itertools.chain.from_iterable(mapped[c] for c in parentcodes),len(vals))
+                numrows = sum(counts)
+        else:
+            raise Exception("sweep_table() only supports constants, lists, Range, and Mapper values (use sweep() for %s)"%str(key))
+        statekeys.append(key)
+        values[key] = vals
+        # constraints: test each distinct combination of the keys they read once
+        for where in predicates:
+            results = {}
+            rows = []
+            wherecodes = [codes[k] for k in where.keys]
+            for i in range(numrows):
+                combo = tuple(col[i] for col in wherecodes)
+                if combo not in results:
+                    results[combo] = where.test(dict((k,values[k][c]) for k,c in zip(where.keys,combo)))
+                if results[combo]:
+                    rows.append(i)
+            codes = select_rows(codes,rows)
+            numrows = len(rows)
+    return SweepTable(keys,statekeys,values,codes,numrows)
+
+#################################
+# Composing sweeps
+#################################
+def sweep_size(sweeper):
+    ''' The number of states of a Sweep, composed sweep, or sequence '''
+    return sweeper.size() if hasattr(sweeper,'size') else len(sweeper)
+
+def merge_pairs(pairs):
+    ''' Combines the keys,state pairs of several sweeps into one, renumbering 
+        the int keys of constants so that those of different sweeps stay apart
+    '''
+    keys = []
+    state = {}
+    offset = 0
+    for partkeys,partstate in pairs:
+        top = 0
+        for key in partkeys:
+            if isinstance(key,int):
+                top = max(top,key)
+                key += offset
+            keys.append(key)
+        for key,val in partstate.items():
+            state[key+offset if isinstance(key,int) else key] = val
+        offset += top
+    return keys,state
+
+class ComposedSweep():
+    ''' Shared indexing for sweeps built out of other sweeps. Subclasses 
+        define __iter__, size() and item(i) (for 0<=i<size) '''
+    def __len__(self):
+        return self.size()
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return list(self.islice(*i.indices(len(self))))
+        size = self.size()
+        if i<0:
+            i += size
+        if not 0<=i<size:
+            raise IndexError("%s index out of range"%self.__class__.__name__)
+        return self.item(i)
+    def islice(self,start=0,stop=None,step=1):
+        ''' Lazily yields the states from index start (inclusive) to stop (exclusive) '''
+        if stop is None:
+            stop = self.size()
+        i = start
+        while i<stop:
+            yield self[i]
+            i += step
+
+class Chain(ComposedSweep):
+    '''
+    All the states of each sweep, one sweep after another (e.g. a union 
+    of grids). Each sweep may be a Sweep or any other composed sweep.
+    '''
+    def __init__(self,*sweeps):
+        self.sweeps = sweeps
+        self.cumlens = None
+    def __iter__(self):
+        for sweeper in self.sweeps:
+            for keys,state in sweeper:
+                yield keys,state
+    def size(self):
+        if self.cumlens is None:
+            total = 0
+            self.cumlens = []
+            for sweeper in self.sweeps:
+                total += sweep_size(sweeper)
+                self.cumlens.append(total)
+        return self.cumlens[-1] if self.cumlens else 0
+    def item(self,i):
+        j = bisect.bisect_right(self.cumlens,i)
+        return self.sweeps[j][i-self.cumlens[j-1] if j>0 else i]
+
+class Zip(ComposedSweep):
+    '''
+    Sweeps that advance together rather than multiplying: the i-th state 
+    combines the i-th state of every sweep, stopping with the shortest one.
+    '''
+    def __init__(self,*sweeps):
+        self.sweeps = sweeps
+    def __iter__(self):
+        iterators = [iter(sweeper) for sweeper in self.sweeps]
+        while True:
+            pairs = []
+            for it in iterators:
+                try:
+                    pairs.append(next(it))
+                except StopIteration:
+                    return
+            yield merge_pairs(pairs)
+    def size(self):
+        return min(sweep_size(sweeper) for sweeper in self.sweeps)
+    def item(self,i):
+        return merge_pairs([sweeper[i] for sweeper in self.sweeps])
+
+class Product(ComposedSweep):
+    '''
+    Every combination of the states of each sweep, later sweeps varying 
+    fastest, as if their arguments had been passed to a single sweep(). 
+    The sweeps are iterated again for each state of the ones before them 
+    rather than being stored, so they must be re-iterable (a Sweep or 
+    composed sweep, not a sweep() generator).
+
+    To nest a plain sub-sweep, pass the Sweep to sweep() or Sweep() as one 
+    of its arguments instead; its arguments are spliced in where it appears.
+    '''
+    def __init__(self,*sweeps):
+        self.sweeps = sweeps
+    def __iter__(self):
+        if not self.sweeps:
+            return
+        for pairs in self.combinations(0):
+            yield merge_pairs(pairs)
+    def combinations(self,depth):
+        if depth==len(self.sweeps):
+            yield []
+            return
+        for pair in self.sweeps[depth]:
+            for rest in self.combinations(depth+1):
+                yield [pair]+rest
+    def size(self):
+        if not self.sweeps:
+            return 0
+        size = 1
+        for sweeper in self.sweeps:
+            size *= sweep_size(sweeper)
+        return size
+    def item(self,i):
+        pairs = []
+        for sweeper in reversed(self.sweeps):
+            n = sweep_size(sweeper)
+            pairs.insert(0,sweeper[i%n])
+            i //= n
+        return merge_pairs(pairs)
+
+class Sample(ComposedSweep):
+    '''
+    n states of a sweep chosen at random without replacement (all of them 
+    if there are fewer), in the order the sweep would yield them. The same 
+    seed always picks the same states.
+
+    If the sweep can be indexed (a Sweep or composed sweep), n indices are 
+    drawn and decoded directly, so the rest of the sweep is never 
+    enumerated. Otherwise (e.g. a sweep() generator) the states are 
+    reservoir sampled in a single pass, keeping only n at a time.
+    '''
+    def __init__(self,sweeper,n,seed=None):
+        self.sweeper = sweeper
+        self.n = n
+        self.seed = seed
+        self.indices = None
+    def indexable(self):
+        return hasattr(self.sweeper,'__getitem__') and (hasattr(self.sweeper,'size') or hasattr(self.sweeper,'__len__'))
+    def choose(self):
+        ''' The sorted indices of the sample (Floyd's algorithm) '''
+        if self.indices is None:
+            rng = random.Random(self.seed)
+            size = sweep_size(self.sweeper)
+            chosen = set()
+            for j in range(max(size-self.n,0),size):
+                t = rng.randint(0,j)
+                chosen.add(t if t not in chosen else j)
+            self.indices = sorted(chosen)
+        return self.indices
+    def __iter__(self):
+        if self.indexable():
+            for i in self.choose():
+                yield self.sweeper[i]
+            return
+        rng = random.Random(self.seed)
+        reservoir = [] # (index,(keys,state))
+        for i,(keys,state) in enumerate(self.sweeper):
+            if len(reservoir)<self.n:
+                reservoir.append((i,(keys,dict(state))))
+            else:
+                j = rng.randint(0,i)
+                if j<self.n:
+                    reservoir[j] = (i,(keys,dict(state)))
+        for i,pair in sorted(reservoir,key=lambda item: item[0]):
+            yield pair
+    def size(self):
+        return len(self.choose())
+    def item(self,i):
+        return self.sweeper[self.choose()[i]]
+
+class Commands():
+    '''
+    The command strings (see join) of the states of a sweep, computed as 
+    they are needed, e.g. to pass a sweep to jobfarm's farm_jobs. Supports 
+    len() and indexing when the sweep does, which lets a resumed farm_jobs 
+    skip straight to the jobs that remain.
+    '''
+    def __init__(self,sweeper,delim=' ',equals='='):
+        self.sweeper = sweeper
+        self.delim = delim
+        self.equals = equals
+    def __iter__(self):
+        for keys,state in self.sweeper:
+            yield join(keys,state,self.delim,self.equals)
+    def __len__(self):
+        return len(self.sweeper)
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [join(keys,state,self.delim,self.equals) for keys,state in self.sweeper[i]]
+        keys,state = self.sweeper[i]
+        return join(keys,state,self.delim,self.equals)
+
 #################################
 # Demo usage
 #################################
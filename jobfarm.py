@@ -23,6 +23,21 @@ import random
 import paramiko
 import multiprocessing 
 import signal
+import select
+import threading
+import heapq
+import subprocess
+import sys
+import gzip
+import shutil
+import json
+import hashlib
+import io
+import codecs
+try:
+    import queue # python3
+except ImportError:
+    import Queue as queue # python2
 
 UTF8="utf-8"
 
@@ -32,124 +47,1221 @@ class PoisonPill():
     def __eq__(self, other):
         return isinstance(other,PoisonPill)
 
+class JobResult():
+    def __init__(self):
+        self.exit_code = None
+        self.cancelled = False # stopped because another copy finished first
+
+class JobJournal():
+    """ An append-only record of when each job (by index) was dispatched and 
+        finished, shared by all workers. Each line is written with a single 
+        append so lines from different processes do not interleave, and the 
+        file is fsync'ed every sync_every records or sync_interval seconds 
+        rather than after every line. """
+    def __init__(self, path, sync_every=100, sync_interval=1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.fd = None
+        self.pid = None
+        self.lock = threading.Lock()
+    def record(self, event, i, *fields):
+        line = "\t".join([event,str(i)]+[str(f) for f in fields])+"\n"
+        with self.lock:
+            if self.pid != os.getpid(): # opened per process (after fork)
+                self.fd = os.open(self.path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+                self.pid = os.getpid()
+                self.unsynced = 0
+                self.last_sync = time.time()
+            os.write(self.fd, line.encode(UTF8))
+            self.unsynced += 1
+            if self.unsynced>=self.sync_every or time.time()-self.last_sync>=self.sync_interval:
+                self.sync()
+    def sync(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.fsync(self.fd)
+            self.unsynced = 0
+            self.last_sync = time.time()
+    def close(self):
+        with self.lock:
+            self.sync()
+            if self.fd is not None and self.pid == os.getpid():
+                os.close(self.fd)
+            self.fd = None
+            self.pid = None
+    def dispatched(self, i, host):
+        self.record("dispatch", i, host)
+    def finished(self, i, exit_code):
+        self.record("finish", i, exit_code)
+    def completed(self):
+        """ indices of jobs that finished successfully (exit code 0) """
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        for line in open(self.path):
+            fields = line.rstrip("\n").split("\t")
+            if len(fields)==3 and fields[0]=="finish" and fields[2]=="0":
+                done.add(int(fields[1]))
+        return done
+
+
+def job_key(command, fingerprint=None):
+    """ the content hash of a command (and of fingerprint, if given) """
+    key = hashlib.sha1(command.encode(UTF8))
+    if fingerprint is not None:
+        key.update(b"\0"+fingerprint.encode(UTF8))
+    return key.hexdigest()
+
+
+class ResultCache():
+    """ The exit code and output of jobs that already ran, kept in a 
+        directory by the hash of the command (see job_key), so that the same 
+        command is never run twice. fingerprint (any string, e.g. a code 
+        version or the values of environment variables the jobs depend on) 
+        is hashed along with each command; results stored under a different 
+        fingerprint are ignored. Only jobs that exit with code 0 are stored 
+        unless failures is set. 
+
+        Each result is stored as [directory]/[xx]/[hash].out, .err and .exit, 
+        and the .exit file (written last) is what marks the result complete. """
+    def __init__(self, directory, fingerprint=None, failures=False):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.failures = failures
+    def path(self, job, ext):
+        key = job_key(job,self.fingerprint)
+        return os.path.join(self.directory,key[:2],key+ext)
+    def lookup(self, job):
+        """ the stored exit code of job, or None if it has not been run """
+        try:
+            with open(self.path(job,".exit")) as f:
+                return json.load(f)["exit_code"]
+        except (IOError,OSError,ValueError,KeyError):
+            return None
+    def replay(self, job, result):
+        """ yields the stored output of job like Worker.execute_job does """
+        for ext,stream in ((".out",0),(".err",1)):
+            with io.open(self.path(job,ext),'r',encoding=UTF8,errors='replace') as f:
+                for data in iter(lambda: f.read(32768),u""):
+                    yield ((data,),None) if stream==0 else (None,(data,))
+        result.exit_code = self.lookup(job)
+    def store(self, job, result, outputs):
+        """ passes along the output of outputs (from Worker.execute_job) 
+            while saving it as the result of job """
+        tmp = ".tmp%d-%d" % (os.getpid(),threading.current_thread().ident)
+        paths = [self.path(job,ext) for ext in (".out",".err",".exit")]
+        try:
+            os.makedirs(os.path.dirname(paths[0]))
+        except OSError:
+            pass # already exists
+        committed = False
+        try:
+            with open(paths[0]+tmp,'wb') as outfile, open(paths[1]+tmp,'wb') as errfile:
+                for outmsg,errmsg in outputs:
+                    if outmsg is not None:
+                        outfile.write("".join(outmsg).encode(UTF8))
+                    if errmsg is not None:
+                        errfile.write("".join(errmsg).encode(UTF8))
+                    yield outmsg,errmsg
+            if result.exit_code==0 or (self.failures and result.exit_code is not None):
+                with open(paths[2]+tmp,'w') as f:
+                    json.dump({"exit_code":result.exit_code, "command":job}, f)
+                for path in paths: # the output first, so the .exit file only appears with it
+                    os.rename(path+tmp,path)
+                committed = True
+        finally:
+            if not committed:
+                for path in paths:
+                    if os.path.exists(path+tmp):
+                        os.remove(path+tmp)
+
+
+class Job():
+    """ A job (command) along with a hint of how expensive it is (any number; 
+        bigger means slower). Job generators may yield these instead of 
+        plain commands so that a Scheduler can take cost into account. """
+    def __init__(self, command, cost=None):
+        self.command = command
+        self.cost = cost
+
+
+class Scheduler():
+    """ Decides the order in which jobs are handed to hosts: by default, 
+        first come first served. 
+
+        steal, if set, lets slots that run out of work near the end of a run 
+        start backup copies of jobs still running on other hosts that are no 
+        faster than their own (see the weight in parse_hosts). Whichever copy 
+        finishes first counts and the other copy is cancelled (its process 
+        killed, or its ssh channel closed), so one slow or overloaded host 
+        does not hold up the whole run. Jobs run in batches (batch_seconds) 
+        are never backed up. """
+    def __init__(self, steal=False):
+        self.steal = steal
+    def order(self, jobs):
+        """ takes (i,job,cost) tuples in production order and yields them in 
+            the order they should be run """
+        return jobs
+
+
+class LongestJobFirst(Scheduler):
+    """ Runs the most expensive jobs (by Job cost) first, so that long jobs 
+        do not end up running alone at the end. window bounds how many jobs 
+        are held back to be sorted (None sorts all of them, which means 
+        generating every job before running any). """
+    def __init__(self, window=None, steal=False):
+        super(LongestJobFirst, self).__init__(steal)
+        self.window = window
+    def order(self, jobs):
+        heap = []
+        for i,job,cost in jobs:
+            heapq.heappush(heap,(-(cost or 0),i,job))
+            if self.window is not None and len(heap)>=self.window:
+                negcost,i,job = heapq.heappop(heap)
+                yield i,job,-negcost
+        while heap:
+            negcost,i,job = heapq.heappop(heap)
+            yield i,job,-negcost
+
+
+# marks the attempt number of a backup copy of a job (see Scheduler)
+BACKUP = -1
+
+class JobQueues():
+    """ The queues and counters shared by the producer and all workers. 
+        Jobs travel as (job,i,attempt,queued time) tuples. """
+    def __init__(self, maxsize, max_retries=3, journal=None, steal=False, log=None, metrics=None, cache=None):
+        self.jobs = multiprocessing.JoinableQueue(maxsize) # new jobs
+        self.retries = multiprocessing.Queue() # jobs whose host failed (run first)
+        self.failed = multiprocessing.Queue() # (i,job) that ran out of retries
+        self.outstanding = multiprocessing.Value('i',0) # produced but not yet finished/failed
+        self.producing = multiprocessing.Value('b',1) # producer still running
+        self.first_dispatch = multiprocessing.Value('d',0.0) # when the first job was assigned
+        self.duplicates = multiprocessing.Value('i',0) # identical jobs that were not produced again
+        self.max_retries = max_retries
+        self.journal = journal
+        self.cache = cache # ResultCache (if any)
+        self.log = log # LogWriter queue that all log lines go through (if any)
+        self.metrics = metrics # FarmMetrics queue that measurements are sent to (if any)
+        # jobs currently running (only tracked when backup copies may be run):
+        # i -> (job,worker name,host weight,start time,whether it has a backup)
+        self.manager = multiprocessing.Manager() if steal else None
+        self.running = self.manager.dict() if steal else None
+        # jobs with a backup copy that one of the copies finished (the other is cancelled)
+        self.settled = self.manager.dict() if steal else None
+        self.steal_lock = multiprocessing.Lock()
+    def put(self, job, i):
+        with self.outstanding.get_lock():
+            self.outstanding.value += 1
+        self.jobs.put((job,i,0,time.time())) # blocking class (will wait when queue fills)
+    def done(self, i):
+        with self.outstanding.get_lock():
+            self.outstanding.value -= 1
+    def remaining(self):
+        """ whether any jobs may still need to be run """
+        return self.producing.value or self.outstanding.value>0
+    def started(self, job, i, name, weight):
+        if self.running is not None:
+            self.running[i] = (job,name,weight,time.time(),False)
+    def finish(self, i):
+        """ marks job i as done; returns False if another copy of it already finished """
+        if self.running is not None:
+            with self.steal_lock: # not while steal() is looking at it
+                entry = self.running.pop(i,None)
+                if entry is None:
+                    return False
+                if entry[4]: # the other copy is still running
+                    self.settled[i] = True
+        self.done(i)
+        return True
+    def superseded(self, i):
+        """ whether another copy of job i already finished """
+        return self.settled is not None and i in self.settled
+    def steal(self, name, weight):
+        """ picks the longest running job on a host no faster than weight 
+            (that has no backup yet) to run a backup copy of """
+        if self.running is None:
+            return None
+        with self.steal_lock:
+            candidates = [(start,i,job) for i,(job,runner,w,start,backed) in self.running.items() 
+                          if not backed and runner!=name and w<=weight]
+            if not candidates:
+                return None
+            start,i,job = min(candidates)
+            entry = self.running.get(i)
+            if entry is None: # finished in the meantime
+                return None
+            job,runner,w,start,backed = entry
+            self.running[i] = (job,runner,w,start,True)
+        return job,i,BACKUP,time.time()
+    def retry(self, job, i, attempt):
+        """ requeues a job whose host failed; returns False if it is out of retries """
+        if self.running is not None:
+            with self.steal_lock: # not while steal() is looking at it
+                if self.running.pop(i,None) is None:
+                    return True # a backup copy already finished it
+        if attempt<self.max_retries:
+            self.retries.put((job,i,attempt+1,time.time()))
+            return True
+        self.failed.put((i,job))
+        if self.journal is not None:
+            self.journal.record("failed", i)
+        self.done(i)
+        return False
+    def abandon(self):
+        """ fails every job waiting to be retried (when no host is left to 
+            run them); returns their (i,job) pairs """
+        abandoned = []
+        while True:
+            try:
+                job,i,attempt,queued = self.retries.get(timeout=0.1)
+            except queue.Empty:
+                return abandoned
+            abandoned.append((i,job))
+            if self.journal is not None:
+                self.journal.record("failed", i)
+            self.done(i)
+    def report(self, *event):
+        if self.metrics is not None:
+            self.metrics.put(event)
+    def close(self):
+        """ stops the queues' feeder threads and the manager process (once 
+            no process uses them any more) """
+        for q in (self.jobs,self.retries,self.failed,self.log,self.metrics):
+            if q is not None:
+                q.close()
+                q.join_thread()
+        if self.manager is not None:
+            self.manager.shutdown()
+    def record_dispatch(self):
+        if self.first_dispatch.value==0:
+            with self.first_dispatch.get_lock():
+                if self.first_dispatch.value==0:
+                    self.first_dispatch.value = time.time()
+
+
 class JobProducer(multiprocessing.Process):
-    def __init__(self,job_generator,q,num_hosts):
+    def __init__(self,job_generator,queues,num_hosts,skip=None,scheduler=None,dedup=False):
         self.job_generator = job_generator
-        self.q = q
+        self.dedup = dedup # drop jobs identical to one produced earlier
+        self.scheduler = scheduler or Scheduler()
+        self.queues = queues
         self.num_hosts = num_hosts
         self.num_produced = 0
+        self.skip = skip or set() # indices of jobs that should not be run again
         super(JobProducer, self).__init__()
+    def jobs(self):
+        # sequences (e.g. a list of commands) can jump straight to the jobs that remain
+        size = None
+        if self.skip and hasattr(self.job_generator,'__getitem__') and hasattr(self.job_generator,'__len__'):
+            try:
+                size = len(self.job_generator)
+            except (TypeError,OverflowError): # e.g. a view of something unsized
+                pass
+        if size is not None:
+            for i in range(size):
+                if i not in self.skip:
+                    yield i,self.job_generator[i]
+        else:
+            for i,job in enumerate(self.job_generator):
+                if i not in self.skip:
+                    yield i,job
+    def costs(self):
+        seen = set() # hashes (not commands) of the jobs so far, to keep this small
+        for i,job in self.jobs():
+            job,cost = (job.command,job.cost) if isinstance(job,Job) else (job,None)
+            if self.dedup:
+                key = job_key(job)
+                if key in seen:
+                    with self.queues.duplicates.get_lock():
+                        self.queues.duplicates.value += 1
+                    continue
+                seen.add(key)
+            yield i,job,cost
     def run(self):
-        for i,job in enumerate(self.job_generator):
-            self.num_produced = i+1
-            self.q.put((job,i)) # blocking class (will wait when queue fills)
+        for i,job,cost in self.scheduler.order(self.costs()):
+            self.num_produced += 1
+            self.queues.put(job,i)
+        self.queues.producing.value = 0
         for i in range(self.num_hosts+5): # make a few extra just in case
-            self.q.put(PoisonPill(self.num_produced)) # signal done
+            self.queues.jobs.put(PoisonPill(self.num_produced)) # signal done
 
 
+# waits between attempts to reconnect to a failed host (doubling up to the max)
+RECONNECT_BACKOFF = 1
+MAX_RECONNECT_BACKOFF = 64
+# failed reconnects in a row after which a host is given up on
+MAX_RECONNECTS = 6
+# channels one ssh connection may carry at once (sshd's MaxSessions, 10 by default)
+MAX_SESSIONS = 10
+
 class Worker(multiprocessing.Process):
-    def __init__(self, index, host, q, logdir, masterlogger, pollint):
+    def __init__(self, index, host, queues, logdir, masterlogger, pollint, slots=1, weight=1.0, job_output=False, batch_seconds=None, max_batch=100, max_reconnects=MAX_RECONNECTS):
         self.index = index
         self.host = host
-        self.q = q
+        self.weight = weight # relative speed of this host
+        self.queues = queues
         self.pollint=pollint
+        self.slots=slots # number of jobs to run on this host at once
+        self.setup_lock = threading.Lock() # slots share one connection
+        self.slot = threading.local() # which slot (index) the current thread is
+        self.max_reconnects = max_reconnects
+        self.dead = threading.Event() # set once the host has been given up on
+        self.journal = queues.journal
+        self.cache = queues.cache
         # open log file
-        self.host_outlogger = setup_logger(os.devnull if logdir is None else "%s/%s.out"%(logdir,self.name()), log_to_console=False)
-        self.host_errlogger = setup_logger(os.devnull if logdir is None else "%s/%s.err"%(logdir,self.name()), log_to_console=False)
+        self.host_outlogger = setup_logger(os.devnull if logdir is None else "%s/%s.out"%(logdir,self.worker_name()), log_to_console=False, log_queue=queues.log)
+        self.host_errlogger = setup_logger(os.devnull if logdir is None else "%s/%s.err"%(logdir,self.worker_name()), log_to_console=False, log_queue=queues.log)
+        # raw output of each job in its own files (logdir/jobs/[i].out and .err)
+        self.jobdir = os.path.join(logdir,'jobs') if (job_output and logdir is not None) else None
         self.masterlogger = masterlogger
+        # run several jobs per command, as many as take about batch_seconds (see run_batch)
+        self.batch_seconds = batch_seconds
+        self.max_batch = max_batch
+        self.job_seconds = None # average job duration so far
+        self.batch_lock = threading.Lock()
         super(Worker, self).__init__()
-    def name(self):
+    def worker_name(self):
         return "%d-%s" % (self.index,self.host)
     def run(self):
-        for job,i in iter(self.q.get, PoisonPill()):
-            self.q.task_done() # signal 
-            self.masterlogger.info("%s: assigning job #%d" % (self.name(),i))
-            # make sure the connection is good
-            if not self.ensure_setup():
-                self.masterlogger.error("%s: removing host and losing job #%d" % (self.name(),i))
-                return # no connection
-            # execute command 
+        if self.slots==1:
+            self.work_slot(0)
+        else:
+            # each slot takes jobs from the queue and runs them over the shared connection
+            threads = [threading.Thread(target=self.work_slot,args=(slot,)) for slot in range(self.slots)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.shutdown()
+    def jobs(self):
+        """ yields (job,i,attempt,queued) until every job has finished or failed 
+            for good. Jobs being retried come first. """
+        state = {'producing':True}
+        while True:
+            item = self.next_job(state)
+            if item is None:
+                return
+            yield item
+    def next_job(self, state, wait=True):
+        """ the next (job,i,attempt,queued) to run, or None once every job has 
+            finished or failed for good. Unless wait is set, None also when 
+            no job is queued right now (rather than waiting on the producer 
+            or on jobs running elsewhere). state keeps track of the producer 
+            across calls. """
+        while True:
             try:
-                self.host_outlogger.info("job #%d: %s"%(i,job))
-                for outmsg,errmsg in self.execute_job(job): # incremental logging
+                return self.queues.retries.get_nowait()
+            except queue.Empty:
+                pass
+            if state['producing']:
+                try:
+                    item = self.queues.jobs.get(wait)
+                except queue.Empty:
+                    return None
+                self.queues.jobs.task_done() # signal 
+                if item == PoisonPill():
+                    state['producing'] = False
+                else:
+                    return item
+            elif wait and self.queues.outstanding.value>0:
+                # jobs are still running elsewhere and might come back to be retried
+                try:
+                    return self.queues.retries.get(timeout=self.pollint)
+                except queue.Empty:
+                    pass
+                # ...or be finished sooner by running a backup copy here
+                backup = self.queues.steal(self.worker_name(),self.weight)
+                if backup is not None:
+                    return backup
+            else:
+                return None
+    def reconnect(self):
+        """ tries to re-establish a failed connection, waiting longer after 
+            each failure; gives up once there are no jobs left or after 
+            max_reconnects failures in a row (then the host is dead for the 
+            rest of the run, for all of its slots) """
+        backoff = RECONNECT_BACKOFF
+        for attempt in range(self.max_reconnects):
+            if self.dead.is_set() or not self.queues.remaining():
+                return False
+            time.sleep(backoff)
+            with self.setup_lock:
+                if self.dead.is_set():
+                    return False
+                if self.ensure_setup():
+                    return True
+            backoff = min(2*backoff,MAX_RECONNECT_BACKOFF)
+            if attempt+1<self.max_reconnects:
+                self.masterlogger.error("%s: reconnect failed, retrying in %ds" % (self.worker_name(),backoff))
+        if not self.dead.is_set():
+            self.dead.set()
+            self.masterlogger.error("%s: giving up on host after %d failed reconnects" % (self.worker_name(),self.max_reconnects))
+        return False
+    def requeue(self, job, i, attempt):
+        if attempt==BACKUP:
+            self.masterlogger.error("%s: dropping backup copy of job #%d" % (self.worker_name(),i))
+        elif self.queues.retry(job,i,attempt):
+            self.masterlogger.error("%s: requeueing job #%d (attempt %d of %d)" % (self.worker_name(),i,attempt+2,self.queues.max_retries+1))
+        else:
+            self.masterlogger.error("%s: giving up on job #%d after %d attempts" % (self.worker_name(),i,attempt+1))
+    def work_slot(self, slot):
+        self.slot.index = slot
+        self.work()
+    def work(self):
+        if self.batch_seconds is not None:
+            return self.work_batches()
+        for job,i,attempt,queued in self.jobs():
+            if not self.run_job(job,i,attempt,queued):
+                return # no connection and nothing left to do
+    def assign(self, job, i, attempt):
+        if attempt==BACKUP:
+            self.masterlogger.info("%s: assigning backup copy of job #%d" % (self.worker_name(),i))
+        else:
+            self.masterlogger.info("%s: assigning job #%d" % (self.worker_name(),i))
+            self.queues.started(job,i,self.worker_name(),self.weight)
+        self.queues.record_dispatch()
+        if self.journal is not None:
+            self.journal.dispatched(i,self.worker_name())
+    def connect(self, items):
+        """ makes sure the connection is good; if not, requeues the jobs in 
+            items and waits to reconnect. Returns whether to go ahead, and 
+            whether there is any point in going on at all """
+        with self.setup_lock:
+            if self.ensure_setup():
+                return True,True
+        for job,i,attempt,queued in items:
+            self.requeue(job,i,attempt)
+        return False,self.reconnect()
+    def run_job(self, job, i, attempt, queued):
+        """ runs one job; returns False if the host failed and there is 
+            nothing left to do """
+        dispatched = time.time()
+        self.assign(job,i,attempt)
+        # a job that already ran is not run again
+        cached = self.cache is not None and self.cache.lookup(job) is not None
+        if not cached:
+            connected,alive = self.connect([(job,i,attempt,queued)])
+            if not connected:
+                return alive
+        # execute command 
+        try:
+            self.host_outlogger.info("job #%d: %s%s"%(i,job," (cached)" if cached else ""))
+            result = JobResult()
+            self.slot.job = i # so that execute_job can tell when to cancel it
+            if cached:
+                outputs = self.cache.replay(job,result)
+            elif self.cache is not None:
+                outputs = self.cache.store(job,result,self.execute_job(job,result))
+            else:
+                outputs = self.execute_job(job,result)
+            outbytes = self.log_output(i,outputs)
+            self.complete(i,result,queued,dispatched,outbytes,cached)
+        except:
+            self.masterlogger.error("%s: error sending job #%d to host. \n%s" % (self.worker_name(),i,traceback.format_exc()))
+            self.requeue(job,i,attempt)
+            return self.reconnect() # communication with this worker failed
+        finally:
+            self.slot.job = None
+        return True
+    def cancelled(self):
+        """ whether the job of the current slot should be stopped because 
+            another copy of it already finished (see JobQueues.steal) """
+        i = getattr(self.slot,'job',None)
+        return i is not None and self.queues.superseded(i)
+    def log_output(self, i, outputs):
+        """ logs the (outmsg,errmsg) pairs of job i as they arrive; returns 
+            the number of bytes of output """
+        outbytes = 0
+        if self.jobdir is None:
+            for outmsg,errmsg in outputs: # incremental logging
+                if outmsg is not None:
+                    outmsg = "".join(outmsg)
+                    outbytes += len(outmsg.encode(UTF8)) # bytes, as in the job_output files
+                    self.host_outlogger.info(outmsg.strip())
+                if errmsg is not None:
+                    errmsg = "".join(errmsg)
+                    outbytes += len(errmsg.encode(UTF8))
+                    self.host_errlogger.info(errmsg.strip())
+        else:
+            # stream output as is, skipping the host logs
+            with open(os.path.join(self.jobdir,"%d.out"%i),'ab') as outfile, open(os.path.join(self.jobdir,"%d.err"%i),'ab') as errfile:
+                for outmsg,errmsg in outputs:
                     if outmsg is not None:
-                        self.host_outlogger.info("".join(outmsg).strip())
+                        outmsg = "".join(outmsg).encode(UTF8)
+                        outbytes += len(outmsg)
+                        outfile.write(outmsg)
                     if errmsg is not None:
-                        self.host_errlogger.info("".join(errmsg).strip())
-                self.masterlogger.info("%s: finished job #%d" % (self.name(),i))
-                self.host_outlogger.info("finished job #%d\n" % (i))
-            except:
-                self.masterlogger.error("%s: error sending job #%d to host so removing. \n%s" % (self.name(),i,traceback.format_exc()))
-                return # communication with this worker failed--give up
-        self.shutdown()
+                        errmsg = "".join(errmsg).encode(UTF8)
+                        outbytes += len(errmsg)
+                        errfile.write(errmsg)
+        return outbytes
+    def complete(self, i, result, queued, dispatched, outbytes, cached=False):
+        self.queues.report("job",self.worker_name(),dispatched-queued,time.time()-dispatched,outbytes)
+        if result.cancelled:
+            self.queues.finish(i)
+            self.masterlogger.info("%s: cancelled job #%d (another copy finished first)" % (self.worker_name(),i))
+            self.host_outlogger.info("cancelled job #%d\n" % (i))
+            return
+        if self.journal is not None:
+            self.journal.finished(i,result.exit_code)
+        if self.queues.finish(i):
+            self.masterlogger.info("%s: finished job #%d%s" % (self.worker_name(),i," (cached)" if cached else ""))
+        else:
+            self.masterlogger.info("%s: finished job #%d (another copy finished first)" % (self.worker_name(),i))
+        self.host_outlogger.info("finished job #%d\n" % (i))
+    def batch_size(self):
+        """ how many jobs to run in the next batch: enough to take about 
+            batch_seconds at the average job duration seen so far """
+        with self.batch_lock:
+            if self.job_seconds is None:
+                return 1 # nothing measured yet
+            return max(1,min(self.max_batch,int(self.batch_seconds/max(self.job_seconds,1e-3))))
+    def observe(self, seconds):
+        """ updates the (exponentially weighted) average job duration """
+        with self.batch_lock:
+            self.job_seconds = seconds if self.job_seconds is None else 0.8*self.job_seconds+0.2*seconds
+    def work_batches(self):
+        state = {'producing':True}
+        while True:
+            item = self.next_job(state)
+            if item is None:
+                return
+            # fill the batch with whatever is queued already, without waiting 
+            # on the producer or on jobs running elsewhere (which might be in 
+            # another slot's unfinished batch)
+            batch = [item]
+            size = self.batch_size()
+            while len(batch)<size:
+                item = self.next_job(state,wait=False)
+                if item is None:
+                    break
+                batch.append(item)
+            # jobs that already ran are not part of the batch
+            if self.cache is not None:
+                for cached in [queued for queued in batch if self.cache.lookup(queued[0]) is not None]:
+                    batch.remove(cached)
+                    if not self.run_job(*cached):
+                        return
+            if len(batch)==1:
+                start = time.time()
+                if not self.run_job(*batch[0]):
+                    return
+                self.observe(time.time()-start)
+            elif batch and not self.run_batch(batch):
+                return # no connection and nothing left to do
+    def run_batch(self, batch):
+        """ runs the (job,i,attempt,queued) items of batch one after another 
+            in a single command, logging each job's output and exit code 
+            separately; returns False if the host failed and there is 
+            nothing left to do """
+        for job,i,attempt,queued in batch:
+            self.assign(job,i,attempt)
+        connected,alive = self.connect(batch)
+        if not connected:
+            return alive
+        done = 0
+        try:
+            marker = "@@jobfarm-%016x@@" % random.getrandbits(64) # never part of any real output
+            self.host_outlogger.info("batch of %d jobs: #%s" % (len(batch),", #".join(str(i) for job,i,attempt,queued in batch)))
+            output = BatchOutput(self.execute_job(batch_command([job for job,i,attempt,queued in batch],marker),JobResult()),marker)
+            for j,(job,i,attempt,queued) in enumerate(batch):
+                start = time.time()
+                self.host_outlogger.info("job #%d: %s"%(i,job))
+                result = JobResult()
+                outputs = output.job(j,result)
+                if self.cache is not None:
+                    outputs = self.cache.store(job,result,outputs)
+                outbytes = self.log_output(i,outputs)
+                self.complete(i,result,queued,start,outbytes)
+                self.observe(time.time()-start)
+                done += 1
+            output.close()
+        except:
+            self.masterlogger.error("%s: error sending batch of jobs #%s to host. \n%s" % (self.worker_name(),", #".join(str(i) for job,i,attempt,queued in batch[done:]),traceback.format_exc()))
+            for job,i,attempt,queued in batch[done:]:
+                self.requeue(job,i,attempt)
+            return self.reconnect() # communication with this worker failed
+        return True
+
+
+def batch_command(jobs, marker):
+    """ a single shell command that runs jobs one after another, each in a 
+        subshell, following the output of each (on stdout and on stderr) 
+        with a line '[marker] [j] [exit code]' """
+    lines = []
+    for j,job in enumerate(jobs):
+        lines.append("(\n%s\n)" % job)
+        lines.append("printf '%%s %%d %%d\\n' '%s' %d $?" % (marker,j))
+        lines.append("printf '%%s %%d\\n' '%s' %d >&2" % (marker,j))
+    return "\n".join(lines)
+
+
+class BatchOutput():
+    """ Splits the output of a batch_command (as yielded by execute_job) 
+        back into the output and exit code of each job. """
+    def __init__(self, outputs, marker):
+        self.outputs = outputs
+        self.marker = marker
+        self.current = [0,0] # the job that stdout and stderr are up to
+        self.tails = ["",""] # the end of each stream that may be the start of a marker
+        self.pending = [] # (j,stream,text) read ahead of the job being logged
+        self.exit_codes = {}
+    def split(self, stream, text):
+        """ breaks text from a stream up at markers into (j,stream,text) pieces """
+        text = self.tails[stream]+text
+        while True:
+            at = text.find(self.marker)
+            newline = text.find("\n",at) if at>=0 else -1
+            if newline<0:
+                break
+            if at>0:
+                self.pending.append((self.current[stream],stream,text[:at]))
+            fields = text[at+len(self.marker):newline].split()
+            if int(fields[0])!=self.current[stream]:
+                raise ValueError("batch output out of order: expected job %d, got %s" % (self.current[stream],fields[0]))
+            if stream==0:
+                self.exit_codes[self.current[stream]] = int(fields[1])
+            self.current[stream] += 1
+            text = text[newline+1:]
+        # hold back anything that could be (the start of) a marker line
+        if at>=0:
+            keep = len(text)-at
+        else:
+            keep = 0
+            for k in range(min(len(self.marker)-1,len(text)),0,-1):
+                if text.endswith(self.marker[:k]):
+                    keep = k
+                    break
+        if len(text)>keep:
+            self.pending.append((self.current[stream],stream,text[:len(text)-keep]))
+        self.tails[stream] = text[len(text)-keep:]
+    def job(self, j, result):
+        """ yields the output of the j-th job like execute_job does """
+        while True:
+            for piece in [piece for piece in self.pending if piece[0]==j]:
+                self.pending.remove(piece)
+                yield ((piece[2],),None) if piece[1]==0 else (None,(piece[2],))
+            if self.current[0]>j and self.current[1]>j:
+                result.exit_code = self.exit_codes.pop(j)
+                return
+            try:
+                outmsg,errmsg = next(self.outputs)
+            except StopIteration:
+                raise IOError("batch ended before job %d finished" % j)
+            if outmsg is not None:
+                self.split(0,"".join(outmsg))
+            if errmsg is not None:
+                self.split(1,"".join(errmsg))
+    def close(self):
+        """ reads whatever is left of the batch's output (until it exits) """
+        for outmsg,errmsg in self.outputs:
+            pass
 
 
 class DummyWorker(Worker):
-    def __init__(self, index, host, q, logdir, masterlogger, pollint):
-        super(DummyWorker, self).__init__(index, host, q, logdir, masterlogger, pollint)
+    def __init__(self, *args, **kwargs):
+        super(DummyWorker, self).__init__(*args, **kwargs)
+        self.batch_seconds = None # simulated output has no batch markers
+        self.cache = None # simulated results must not be stored as real ones
     def ensure_setup(self):
         if random.random()<0.2:
-            self.masterlogger.error("%s: DummyWorker simulated outage" % self.name())
+            self.masterlogger.error("%s: DummyWorker simulated outage" % self.worker_name())
             return False
         return True
-    def execute_job(self,job):
+    def execute_job(self,job,result):
         yield "simulated result","simulated error output"
+        result.exit_code = 0
+    def shutdown(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+
+class LocalWorker(Worker):
+    """ Runs jobs as subprocesses of this machine (no ssh); give it as many 
+        slots as jobs should run at once. Each job runs in a process group of 
+        its own so that killing it also kills whatever it started. """
+    # (preexec_fn is not thread safe in python3)
+    NEW_SESSION = {'start_new_session':True} if sys.version_info[0]>=3 else {'preexec_fn':os.setsid}
+    def __init__(self, *args, **kwargs):
+        super(LocalWorker, self).__init__(*args, **kwargs)
+        self.procs = set() # running subprocesses
+    def run(self):
+        try:
+            # the farm's killpg does not reach the jobs' process groups
+            signal.signal(signal.SIGTERM, self.terminate)
+        except ValueError:
+            pass # a thread of the farm process (SignalHandler calls shutdown)
+        super(LocalWorker, self).run()
+    def terminate(self, signum, frame):
+        self.shutdown()
+        os._exit(1)
+    def ensure_setup(self):
+        return True
     def shutdown(self):
-        pass
+        if self.journal is not None:
+            self.journal.sync()
+        for proc in list(self.procs):
+            self.kill(proc)
+    def kill(self, proc):
+        try:
+            os.killpg(proc.pid,signal.SIGKILL)
+        except OSError:
+            pass # already gone
+    def execute_job(self,job,result):
+        proc = subprocess.Popen(job, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **self.NEW_SESSION)
+        self.procs.add(proc)
+        try:
+            # read whatever either pipe has as soon as it arrives
+            streams = {proc.stdout.fileno():0, proc.stderr.fileno():1}
+            decoders = {fd:output_decoder() for fd in streams}
+            while streams:
+                if self.cancelled():
+                    self.kill(proc)
+                    proc.wait()
+                    result.cancelled = True
+                    return
+                readable,_,_ = select.select(list(streams),[],[],self.pollint)
+                for fd in readable:
+                    data = os.read(fd,32768)
+                    msg = decoders[fd].decode(data,not data),
+                    if msg[0]:
+                        yield (msg,None) if streams[fd]==0 else (None,msg)
+                    if not data: # closed
+                        del streams[fd]
+            result.exit_code = proc.wait()
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+            self.procs.discard(proc)
+        self.host_outlogger.info("finished with code %d" % result.exit_code)
 
 
 class SshWorker(Worker):
-    def __init__(self, index, host, q, logdir, masterlogger, pollint):
-        super(SshWorker, self).__init__(index, host, q, logdir, masterlogger, pollint)
-        self.ssh = paramiko.SSHClient()
-        self.ssh.load_system_host_keys('/etc/ssh/ssh_known_hosts')
+    """ Runs jobs over ssh. A host's slots share as few connections as 
+        possible without any of them carrying more than 
+        sessions_per_connection jobs at once (sshd refuses channels beyond 
+        its MaxSessions). """
+    def __init__(self, *args, **kwargs):
+        self.pool = kwargs.pop('pool',None) # HostPool to borrow the connections from
+        self.sessions = kwargs.pop('sessions_per_connection',MAX_SESSIONS)
+        super(SshWorker, self).__init__(*args, **kwargs)
+        self.numconns = max(1,(self.slots+self.sessions-1)//self.sessions)
+        if self.pool is None:
+            self.clients = []
+            for c in range(self.numconns):
+                client = paramiko.SSHClient()
+                client.load_system_host_keys('/etc/ssh/ssh_known_hosts')
+                self.clients.append(client)
+    def connection(self):
+        """ the index of the connection the current slot uses """
+        return getattr(self.slot,'index',0) % self.numconns
+    def conn_name(self, c):
+        return self.worker_name() if self.numconns==1 else "%s (connection %d)" % (self.worker_name(),c)
     def shutdown(self):
-        self.masterlogger.info("%s: closing connection" % (self.name()))
-        self.host_outlogger.info("%s: closing connection" % (self.name()))
-        # set up a short keepalive signal so that remote processes will eventually be killed
-        if self.ssh.get_transport() is not None:
-            self.ssh.get_transport().set_keepalive(1)
-        self.ssh.close()
+        if self.journal is not None:
+            self.journal.sync()
+        if self.pool is not None:
+            return # the connections stay open in the pool
+        self.masterlogger.info("%s: closing connection" % (self.worker_name()))
+        self.host_outlogger.info("%s: closing connection" % (self.worker_name()))
+        for client in self.clients:
+            # set up a short keepalive signal so that remote processes will eventually be killed
+            if client.get_transport() is not None:
+                client.get_transport().set_keepalive(1)
+            client.close()
     def ensure_setup(self):
-        conn = self.ssh.get_transport()
+        c = self.connection()
+        if self.pool is not None:
+            try:
+                self.pool.client(self.host,c)
+                return True
+            except:
+                self.masterlogger.error("%s: connection failed" % (self.conn_name(c)))
+                self.masterlogger.info(traceback.format_exc())
+                return False
+        conn = self.clients[c].get_transport()
         if conn is None or not conn.is_alive():
             try:
-                self.ssh.connect(self.host)
-                self.masterlogger.info("%s: connection succeeded" % self.name())
+                start = time.time()
+                self.clients[c].connect(self.host)
+                self.queues.report("connect",self.worker_name(),time.time()-start)
+                self.masterlogger.info("%s: connection succeeded" % self.conn_name(c))
                 return True
             except:
-                self.masterlogger.error("%s: connection failed" % (self.name()))
+                self.masterlogger.error("%s: connection failed" % (self.conn_name(c)))
                 self.masterlogger.info(traceback.format_exc())
                 return False
         return True
-    def execute_job(self,job):
-        # Send the command (non-blocking)
-        _,stdout,_= self.ssh.exec_command(job)
-        chan = stdout.channel # channel provides access to stdout AND stderr
-        # Wait for the command to terminate
-        while not chan.exit_status_ready():
-            time.sleep(self.pollint)
-            # is there data in stdout? 
-            outmsg,errmsg = None,None
-            if chan.recv_ready():
-                outmsg = chan.recv(1024).decode(UTF8),
-            # is there is data in stderr?
-            elif chan.recv_stderr_ready():
-                errmsg = chan.recv_stderr(1024).decode(UTF8),
-            yield outmsg,errmsg
-        # empty buffers
-        while chan.recv_ready():
-            yield chan.recv(1024).decode(UTF8),None
-        while chan.recv_stderr_ready():
-            yield None,chan.recv_stderr(1024).decode(UTF8)
-        self.host_outlogger.info("finished with code %d" % chan.recv_exit_status())
-
-
-
-def setup_logger(logfile, log_to_console=True, level='INFO'):
-    logger = logging.getLogger(logfile)
+    def execute_job(self,job,result):
+        c = self.connection()
+        if self.pool is not None:
+            self.pool.borrow(self.host,c) # the pool must not close the connection under the job
+            ssh = self.pool.client(self.host,c)
+        else:
+            ssh = self.clients[c]
+        try:
+            # Send the command (non-blocking)
+            _,stdout,_= ssh.exec_command(job)
+            chan = stdout.channel # channel provides access to stdout AND stderr
+            outdec,errdec = output_decoder(),output_decoder()
+            # Wait for output or termination. The channel is selectable, so we wake 
+            # up as soon as either arrives (pollint only bounds the wait)
+            while True:
+                if self.cancelled():
+                    chan.close() # the remote command gets SIGHUP with its session
+                    result.cancelled = True
+                    return
+                if chan.eof_received:
+                    # no more output is coming, but the channel stays selectable 
+                    # from here on, so wait for the exit status instead
+                    chan.status_event.wait(self.pollint)
+                else:
+                    select.select([chan],[],[],self.pollint)
+                # drain both streams completely
+                outmsg = read_available(chan.recv_ready,chan.recv,outdec)
+                errmsg = read_available(chan.recv_stderr_ready,chan.recv_stderr,errdec)
+                if outmsg is not None or errmsg is not None:
+                    yield outmsg,errmsg
+                # done once the job exited and its output has been emptied
+                if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+                    break
+            # whatever is left of a character cut off at the end
+            outmsg,errmsg = outdec.decode(b"",True),errdec.decode(b"",True)
+            if outmsg or errmsg:
+                yield (outmsg,) if outmsg else None,(errmsg,) if errmsg else None
+            result.exit_code = chan.recv_exit_status()
+        finally:
+            if self.pool is not None:
+                self.pool.release(self.host,c)
+        self.host_outlogger.info("finished with code %d" % result.exit_code)
+
+
+class HostPool():
+    """ SSH connections that are kept open and reused across farm_jobs() 
+        calls (pass the same pool to each). Connections are opened in 
+        parallel, kept alive with keepalive packets every keepalive seconds, 
+        checked before being handed out, and closed after idle_timeout 
+        seconds without a job running over them. Call close() when done with 
+        the pool.
+
+        Connections cannot be shared with other processes, so farm_jobs runs 
+        its workers as threads of the calling process when given a pool. """
+    def __init__(self, keepalive=30, idle_timeout=600, known_hosts='/etc/ssh/ssh_known_hosts'):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.known_hosts = known_hosts
+        # a host may have several connections (see SshWorker), so these are 
+        # all by (host,connection index)
+        self.clients = {} # -> paramiko.SSHClient
+        self.last_used = {} # -> time
+        self.borrowers = {} # -> number of jobs running over the connection
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        reaper = threading.Thread(target=self.reap)
+        reaper.daemon = True
+        reaper.start()
+    def healthy(self, client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+    def client(self, host, c=0):
+        """ a connected SSHClient for host (its c-th connection), reconnecting 
+            if necessary """
+        key = (host,c)
+        with self.lock:
+            client = self.clients.get(key)
+            self.last_used[key] = time.time()
+        if client is not None and self.healthy(client):
+            return client
+        client = paramiko.SSHClient()
+        client.load_system_host_keys(self.known_hosts)
+        client.connect(host)
+        client.get_transport().set_keepalive(self.keepalive)
+        with self.lock:
+            old = self.clients.get(key)
+            if old is not None and old is not client and self.healthy(old):
+                client.close() # another thread got there first
+                return old
+            self.clients[key] = client
+        return client
+    def borrow(self, host, c=0):
+        """ marks a connection to host as in use (until release) """
+        key = (host,c)
+        with self.lock:
+            self.borrowers[key] = self.borrowers.get(key,0)+1
+            self.last_used[key] = time.time()
+    def release(self, host, c=0):
+        key = (host,c)
+        with self.lock:
+            self.borrowers[key] -= 1
+            self.last_used[key] = time.time()
+    def connect(self, hosts):
+        """ opens connections to all hosts in parallel; returns the hosts 
+            that could not be reached """
+        failed = []
+        def connect_one(host):
+            try:
+                self.client(host)
+            except:
+                failed.append(host)
+        threads = [threading.Thread(target=connect_one,args=(host,)) for host in set(hosts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return failed
+    def reap(self):
+        """ closes connections that no job is using and that have been idle 
+            for too long """
+        while not self.closed.wait(min(self.keepalive,self.idle_timeout)):
+            with self.lock:
+                idle = [key for key,t in self.last_used.items() 
+                        if time.time()-t>self.idle_timeout and key in self.clients and not self.borrowers.get(key)]
+                clients = [self.clients.pop(key) for key in idle]
+            for client in clients:
+                client.close()
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            client.close()
+
+
+def output_decoder():
+    """ decodes one output stream chunk by chunk; a character split 
+        between chunks is kept for the next one, and bytes that are not 
+        UTF-8 are replaced """
+    return codecs.getincrementaldecoder(UTF8)('replace')
+
+
+def read_available(ready,recv,decoder,bufsize=32768):
+    """ reads everything currently buffered on one stream of a channel 
+        (as a tuple of chunks decoded by decoder, see output_decoder), or 
+        returns None if there is nothing """
+    chunks = []
+    while ready():
+        chunks.append(decoder.decode(recv(bufsize)))
+    return tuple(chunks) if chunks else None
+
+
+class QueueLogHandler(logging.Handler):
+    """ hands log lines to a LogWriter process instead of writing them """
+    def __init__(self, log_queue, logfile, log_to_console):
+        super(QueueLogHandler, self).__init__()
+        self.log_queue = log_queue
+        self.logfile = logfile
+        self.log_to_console = log_to_console
+    def emit(self, record):
+        try:
+            self.log_queue.put((self.logfile, record.created, record.getMessage(), self.log_to_console))
+        except:
+            self.handleError(record)
+
+
+class LogWriter(multiprocessing.Process):
+    """ Writes the log lines of every process (sent through log_queue by 
+        QueueLogHandler) so that lines never interleave and workers never 
+        wait on the disk. Lines are written in batches of whatever has 
+        arrived (up to batch_size), with one flush per batch. 
+
+        rotate_bytes, if set, starts a new file whenever a log grows past 
+        that size (the old one is renamed [logfile].1, .2, ... and, if 
+        compress is set, gzipped). Put None on the queue to stop. """
+    def __init__(self, log_queue, rotate_bytes=None, compress=False, batch_size=1000):
+        self.log_queue = log_queue
+        self.rotate_bytes = rotate_bytes
+        self.compress = compress
+        self.batch_size = batch_size
+        super(LogWriter, self).__init__()
+    def run(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN) # the master handles ctrl+c
+        self.files = {}
+        done = False
+        while not done:
+            batch = [self.log_queue.get()]
+            while len(batch)<self.batch_size:
+                try:
+                    batch.append(self.log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+            self.write(batch)
+        for f in self.files.values():
+            f.close()
+    def write(self, batch):
+        touched = set()
+        console = []
+        for logfile,created,msg,log_to_console in batch:
+            if isinstance(msg,bytes): # python2 str
+                msg = msg.decode(UTF8,'replace')
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(created))
+            line = u"%s,%03d %s\n" % (stamp,int(created*1000)%1000,msg)
+            f = self.files.get(logfile)
+            if f is None:
+                f = self.files[logfile] = io.open(logfile,'a',encoding=UTF8)
+            f.write(line)
+            touched.add(logfile)
+            if log_to_console:
+                console.append(msg+"\n")
+        for logfile in touched:
+            self.files[logfile].flush()
+            if self.rotate_bytes is not None and self.files[logfile].tell()>=self.rotate_bytes:
+                self.rotate(logfile)
+        if console:
+            # as bytes, which python2 (and a non-UTF-8 locale) cannot encode otherwise
+            stdout = getattr(sys.stdout,'buffer',sys.stdout)
+            stdout.write(u"".join(console).encode(UTF8))
+            stdout.flush()
+    def rotate(self, logfile):
+        self.files.pop(logfile).close()
+        n = 1
+        while os.path.exists("%s.%d"%(logfile,n)) or os.path.exists("%s.%d.gz"%(logfile,n)):
+            n += 1
+        rotated = "%s.%d"%(logfile,n)
+        os.rename(logfile,rotated)
+        if self.compress:
+            with open(rotated,'rb') as src, gzip.open(rotated+".gz",'wb') as dst:
+                shutil.copyfileobj(src,dst)
+            os.remove(rotated)
+
+
+class FarmMetrics():
+    """ Collects the measurements workers report (see JobQueues.report) in a 
+        thread of the master process. Every interval seconds it logs a 
+        summary line and, if outdir is given, writes everything so far to 
+        outdir/metrics.json and, in Prometheus text format, to 
+        outdir/metrics.prom. """
+    # upper bounds (seconds) of the job runtime histogram buckets
+    BUCKETS = (0.01, 0.1, 1, 10, 60, 600, 3600, float('inf'))
+    def __init__(self, queues, logger, outdir=None, interval=30):
+        self.queues = queues
+        self.events = queues.metrics
+        self.logger = logger
+        self.outdir = outdir
+        self.interval = interval
+        self.starttime = time.time()
+        self.hosts = {} # worker name -> stats
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+    def host_stats(self, name):
+        if name not in self.hosts:
+            self.hosts[name] = {"jobs":0, "runtime_sum":0.0, "runtime_buckets":[0]*len(self.BUCKETS), 
+                                "dispatch_latency_sum":0.0, "output_bytes":0, "connects":0, "connect_seconds_sum":0.0}
+        return self.hosts[name]
+    def add(self, event):
+        kind,name = event[0],event[1]
+        stats = self.host_stats(name)
+        if kind=="job":
+            latency,runtime,outbytes = event[2:]
+            stats["jobs"] += 1
+            stats["dispatch_latency_sum"] += latency
+            stats["runtime_sum"] += runtime
+            stats["output_bytes"] += outbytes
+            for b,bound in enumerate(self.BUCKETS):
+                if runtime<=bound:
+                    stats["runtime_buckets"][b] += 1
+                    break
+        elif kind=="connect":
+            stats["connects"] += 1
+            stats["connect_seconds_sum"] += event[2]
+    def queue_depth(self):
+        try:
+            return self.queues.jobs.qsize(), self.queues.retries.qsize()
+        except NotImplementedError: # e.g. on mac os
+            return None, None
+    def snapshot(self):
+        elapsed = max(time.time()-self.starttime,1e-9)
+        total = {}
+        for key in ("jobs","runtime_sum","dispatch_latency_sum","output_bytes","connects","connect_seconds_sum"):
+            total[key] = sum(stats[key] for stats in self.hosts.values())
+        total["runtime_buckets"] = [sum(stats["runtime_buckets"][b] for stats in self.hosts.values()) for b in range(len(self.BUCKETS))]
+        queued,retries = self.queue_depth()
+        return {"elapsed":elapsed, "jobs_per_second":total["jobs"]/elapsed, "queue_depth":queued, "retry_queue_depth":retries,
+                "buckets":[str(b) for b in self.BUCKETS], "total":total, "hosts":self.hosts}
+    def summary(self, snap):
+        total = snap["total"]
+        jobs = max(total["jobs"],1)
+        return "metrics: %d jobs (%.2f/s), queue %s (+%s retries), dispatch latency %.3fs, runtime %.3fs, output %d bytes, %d connects (%.3fs)" % (
+            total["jobs"], snap["jobs_per_second"], snap["queue_depth"], snap["retry_queue_depth"],
+            total["dispatch_latency_sum"]/jobs, total["runtime_sum"]/jobs, total["output_bytes"],
+            total["connects"], total["connect_seconds_sum"]/max(total["connects"],1))
+    def prometheus(self, snap):
+        lines = ["jobfarm_jobs_per_second %f" % snap["jobs_per_second"]]
+        if snap["queue_depth"] is not None:
+            lines.append("jobfarm_queue_depth %d" % snap["queue_depth"])
+            lines.append("jobfarm_retry_queue_depth %d" % snap["retry_queue_depth"])
+        for name,stats in sorted(self.hosts.items()):
+            label = 'host="%s"' % name
+            lines.append("jobfarm_jobs_total{%s} %d" % (label,stats["jobs"]))
+            cumulative = 0
+            for bound,count in zip(self.BUCKETS,stats["runtime_buckets"]):
+                cumulative += count
+                lines.append('jobfarm_job_runtime_seconds_bucket{%s,le="%s"} %d' % (label,"+Inf" if bound==float('inf') else bound,cumulative))
+            lines.append("jobfarm_job_runtime_seconds_sum{%s} %f" % (label,stats["runtime_sum"]))
+            lines.append("jobfarm_job_runtime_seconds_count{%s} %d" % (label,stats["jobs"]))
+            lines.append("jobfarm_dispatch_latency_seconds_sum{%s} %f" % (label,stats["dispatch_latency_sum"]))
+            lines.append("jobfarm_dispatch_latency_seconds_count{%s} %d" % (label,stats["jobs"]))
+            lines.append("jobfarm_output_bytes_total{%s} %d" % (label,stats["output_bytes"]))
+            lines.append("jobfarm_connect_seconds_sum{%s} %f" % (label,stats["connect_seconds_sum"]))
+            lines.append("jobfarm_connect_seconds_count{%s} %d" % (label,stats["connects"]))
+        return "\n".join(lines)+"\n"
+    def report(self):
+        snap = self.snapshot()
+        self.logger.info(self.summary(snap))
+        if self.outdir is not None:
+            for filename,content in (("metrics.json",json.dumps(snap,indent=1)),("metrics.prom",self.prometheus(snap))):
+                path = os.path.join(self.outdir,filename)
+                with open(path+".tmp",'w') as f:
+                    f.write(content)
+                os.rename(path+".tmp",path) # readers never see a partial file
+    def drain(self, timeout):
+        deadline = time.time()+timeout
+        while True:
+            try:
+                event = self.events.get(timeout=max(deadline-time.time(),0.001))
+            except queue.Empty:
+                return
+            if event is None: # woken up by stop()
+                return
+            self.add(event)
+            if time.time()>=deadline:
+                return
+    def run(self):
+        while not self.stopped.is_set():
+            self.drain(self.interval)
+            if not self.stopped.is_set():
+                self.report()
+    def start(self):
+        self.thread.start()
+    def stop(self):
+        """ collects whatever is left and writes the final report """
+        self.stopped.set()
+        self.events.put(None)
+        self.thread.join()
+        self.drain(0.1)
+        self.report()
+
+
+def setup_logger(logfile, log_to_console=True, level='INFO', log_queue=None):
+    discard = logfile==os.devnull and not log_to_console # nothing to write
+    # (named apart so as not to replace the handlers of a console-only logger)
+    logger = logging.getLogger(logfile+":discard" if discard else logfile)
     logger.propagate = False # avoid propagating messages to root logger (console)
     logger.setLevel(level)
+    for handler in list(logger.handlers): # in case this logfile was set up before
+        logger.removeHandler(handler)
+    if discard:
+        logger.addHandler(logging.NullHandler())
+        return logger
+    if log_queue is not None:
+        # output to console and/or file via the log writer
+        logger.addHandler(QueueLogHandler(log_queue, logfile, log_to_console))
+        return logger
     if log_to_console:
         # output to console
         streamhandler = logging.StreamHandler()
@@ -162,9 +1274,37 @@ def setup_logger(logfile, log_to_console=True, level='INFO'):
     return logger
 
 
+def remove_queue_handlers(log_queue):
+    """ takes the QueueLogHandlers that send to log_queue off every logger """
+    for logger in list(logging.Logger.manager.loggerDict.values()):
+        for handler in list(getattr(logger,'handlers',[])): # (placeholders have none)
+            if isinstance(handler,QueueLogHandler) and handler.log_queue is log_queue:
+                logger.removeHandler(handler)
+                handler.close()
+
+
+def parse_hosts(hostsfile):
+    """ reads a hosts file with one 'host', 'host:slots' or 'host:slots:weight' 
+        per line and returns a list of (host,slots,weight). weight is the 
+        relative speed of the host (1 by default). It only decides which 
+        hosts may run backup copies of each other's jobs (see Scheduler); 
+        jobs are dispatched to whichever slot is free, so a slow host simply 
+        takes fewer of them """
+    hosts = []
+    for line in open(hostsfile):
+        line = line.strip()
+        if len(line)==0:
+            continue
+        fields = line.split(':')
+        slots = int(fields[1]) if len(fields)>1 and fields[1] else 1
+        weight = float(fields[2]) if len(fields)>2 and fields[2] else 1.0
+        hosts.append((fields[0], slots, weight))
+    return hosts
+
+
 def drain_queue(q):
     unfinished = 0
-    for job,i in iter(q.get, PoisonPill()):
+    for item in iter(q.get, PoisonPill()):
         q.task_done()
         unfinished += 1
     # the producer makes a few extra pills at the end to ensure this works
@@ -181,6 +1321,16 @@ def drain_queue(q):
     return unfinished, total_processed
 
 
+def drain_failed(failed):
+    """ the (i,job) pairs of jobs that ran out of retries """
+    jobs = []
+    while True:
+        try:
+            jobs.append(failed.get(timeout=0.1))
+        except queue.Empty:
+            return jobs
+
+
 SIGTERM_SENT = False
 class SignalHandler:
     """ catch ctrl+c and do emergency cleanup """
@@ -200,15 +1350,23 @@ class SignalHandler:
 
 
 
-def farm_jobs(job_generator, hostsfile, pollint=1, outdir=None, dummy_run=False):
+def farm_jobs(job_generator, hostsfile, pollint=1, outdir=None, dummy_run=False, queue_per_slot=2, resume=False, max_retries=3, scheduler=None, pool=None, local=False, local_slots=None, job_output=False, rotate_bytes=None, compress_logs=False, metrics_interval=30, cache=None, dedup=False, batch_seconds=None, max_batch=100, max_reconnects=MAX_RECONNECTS, sessions_per_connection=MAX_SESSIONS):
     """ 
         This function executes the jobs returned by job_generator by opening an ssh 
         connection to one of the machines in the hostsfile (one host name
-        per line. IMPORTANT: this script is designed to work only after 
+        per line, optionally followed by ':slots' to run that many jobs on 
+        the host at once, and then by ':weight' to give the host's relative 
+        speed, which only matters to Scheduler steal). A host's slots share 
+        one connection, or as many as it takes for none to carry more than 
+        sessions_per_connection jobs at once (sshd's MaxSessions, 10 by 
+        default, is the most it will allow). 
+        IMPORTANT: this script is designed to work only after 
         passphrase-less ssh keys are set up on all host machines (so that you can 
         ssh to each without giving any passwords/phrases).
 
-        pollint defines the polling interval used to check for output.
+        pollint bounds how long to wait for output before checking whether a 
+        job is finished (output and job completion are normally noticed as 
+        soon as they happen).
 
         outdir specifies a directory where host machine (cli) output should 
         be recorded. Each machine is given a name of the form 
@@ -216,49 +1374,159 @@ def farm_jobs(job_generator, hostsfile, pollint=1, outdir=None, dummy_run=False)
         running on is recorded in a file called 'master'.
 
         dummy_run, if set, causes jobs to be assigned to a host and listed 
-        without actually opening any ssh connections or executing jobs, and 
-        can be useful for debugging."""
+        without actually opening any ssh connections or executing jobs (or 
+        touching the cache), and can be useful for debugging.
+
+        queue_per_slot is how many jobs are produced ahead of time for each 
+        slot. Workers start right away and wait on the queue, and the 
+        producer waits when the queue is full, so large job strings are 
+        never buffered far beyond what the hosts can take.
+
+        If outdir is given, every job's dispatch and exit code is recorded 
+        (by job index) in outdir/journal. resume, if set, continues an 
+        earlier run into the same outdir: jobs that already finished with 
+        exit code 0 are skipped. If job_generator is a sequence (supports 
+        len() and indexing), the finished jobs are not even generated.
+
+        If a host cannot be reached or fails while running a job, the job is 
+        put back on the queue (to be run by any host, at most max_retries 
+        more times) and the host is reconnected with exponential backoff. 
+        Jobs that run out of retries are listed at the end. A host that 
+        cannot be reconnected max_reconnects times in a row is given up on; 
+        if every host is given up on, the jobs still waiting to be retried 
+        are listed as failed too.
+
+        scheduler (a Scheduler, e.g. LongestJobFirst) decides the order in 
+        which jobs are run and whether idle hosts may run backup copies of 
+        jobs near the end of the run. job_generator may yield Job objects to 
+        give each command a cost hint.
+
+        pool (a HostPool) provides SSH connections that stay open after this 
+        call returns, so that a series of farm_jobs calls only connects to 
+        each host once. With a pool, workers are threads of this process 
+        and farm_jobs returns normally instead of ending the process 
+        group.
+
+        local, if set, runs the jobs as subprocesses of this machine instead 
+        (hostsfile is then ignored and may be None), local_slots at a time 
+        (by default, one per core).
+
+        All log lines go through a single log writer process. job_output, if 
+        set, streams each job's raw output to outdir/jobs/[i].out and .err 
+        instead of the timestamped host logs. rotate_bytes, if set, starts a 
+        new log file whenever one grows past that size, and compress_logs 
+        gzips the old ones.
+
+        Every metrics_interval seconds, throughput and latency figures (per 
+        host and overall) are summarized in the master log and written to 
+        outdir/metrics.json and outdir/metrics.prom (see FarmMetrics).
+
+        cache (a ResultCache) keeps the exit code and output of every job by 
+        the hash of its command: jobs that are already in the cache are not 
+        run again, and their stored output is logged instead. dedup, if set, 
+        drops jobs identical to one produced earlier in the same run.
+
+        batch_seconds, if set, runs consecutive jobs together in a single 
+        command (so one channel and shell per batch rather than per job), 
+        as many as take about batch_seconds at the average job duration seen 
+        so far, up to max_batch (and max_batch jobs are then produced ahead 
+        of time for each slot, rather than queue_per_slot). Each job's output and exit code are still 
+        logged separately. This is worthwhile when jobs are so short that 
+        starting a command takes longer than running it."""
 
 
     ###################
     # Setup
     ###################
     # logging
-    if outdir is not None:
+    if outdir is not None and not (resume and os.path.isdir(outdir)):
         os.makedirs(outdir)
-    logger = setup_logger(os.devnull if outdir is None else os.path.join(outdir,'master'))
-    # Queue (size is number of jobs to queue in mem at once)
-    q = multiprocessing.JoinableQueue(2 if dummy_run else 5000) 
-    # Consumers
+    if outdir is not None and job_output and not os.path.isdir(os.path.join(outdir,'jobs')):
+        os.makedirs(os.path.join(outdir,'jobs'))
+    log_queue = multiprocessing.Queue()
+    log_writer = LogWriter(log_queue, rotate_bytes, compress_logs)
+    log_writer.start()
+    logger = setup_logger(os.devnull if outdir is None else os.path.join(outdir,'master'), log_queue=log_queue)
+    starttime = time.time()
     logger.info("Setting up the farm.")
-    hosts = [line.strip() for line in open(hostsfile)]
-    worker_ctor = DummyWorker if dummy_run else SshWorker # what kind of worker?
-    workers = [ worker_ctor(i,host,q,outdir,logger,pollint) for i,host in enumerate(hosts) ]
-    # Producer
-    job_producer = JobProducer(job_generator,q,len(workers))
+    # progress journal (what to skip when resuming)
+    journal = None if outdir is None else JobJournal(os.path.join(outdir,'journal'))
+    completed = journal.completed() if (resume and journal is not None) else set()
+    if completed:
+        logger.info("Resuming: skipping %d jobs that already finished" % len(completed))
+    if local:
+        hosts = [('localhost', local_slots or multiprocessing.cpu_count(), 1.0)]
+    else:
+        hosts = parse_hosts(hostsfile)
+    num_slots = sum(slots for host,slots,weight in hosts)
+    # Queues (size is number of jobs to queue in mem at once)
+    queue_size = queue_per_slot*num_slots
+    if batch_seconds is not None:
+        queue_size = max(queue_per_slot,max_batch)*num_slots # room for a full batch per slot
+    scheduler = scheduler or Scheduler()
+    queues = JobQueues(max(1,queue_size),max_retries,journal,scheduler.steal,log_queue,multiprocessing.Queue(),cache)
+    metrics = FarmMetrics(queues,logger,outdir,metrics_interval)
+    # Consumers
+    worker_ctor = DummyWorker if dummy_run else LocalWorker if local else SshWorker # what kind of worker?
+    worker_kwargs = {'job_output':job_output, 'batch_seconds':batch_seconds, 'max_batch':max_batch, 'max_reconnects':max_reconnects}
+    if worker_ctor is SshWorker:
+        worker_kwargs['sessions_per_connection'] = sessions_per_connection
+        if pool is not None:
+            worker_kwargs['pool'] = pool
+    workers = [ worker_ctor(i,host,queues,outdir,logger,pollint,slots,weight,**worker_kwargs) for i,(host,slots,weight) in enumerate(hosts) ]
+    # Producer (each slot needs its own poison pill)
+    job_producer = JobProducer(job_generator,queues,num_slots,completed,scheduler,dedup)
     # handle ctl+c
-    signal.signal(signal.SIGINT, SignalHandler(workers).signal_handler)
+    previous_sigint = signal.signal(signal.SIGINT, SignalHandler(workers).signal_handler)
 
     ###################
     # Get to work!
     ###################
     job_producer.start()
-    time.sleep(10) # wait for jobs to be produced
-    for worker in workers:
-        worker.start()
+    metrics.start()
+    if pool is not None:
+        # pooled connections live in this process, so workers must too
+        if worker_ctor is SshWorker:
+            for host in pool.connect(host for host,slots,weight in hosts):
+                logger.error("%s: connection failed" % host)
+        runners = [threading.Thread(target=worker.run) for worker in workers]
+    else:
+        runners = workers
+    for runner in runners: # workers wait on the queue until jobs are produced
+        runner.start()
     logger.info("Finished initializing workers")
 
     ###################
     # Clean up
     ###################
     # Wait for all to finish
-    for worker in workers:
-        worker.join()
+    for runner in runners:
+        runner.join()
     logger.info("Finished all jobs")
     # Empty queue to get total job count (if necessary)
-    unfinished,total = drain_queue(q)
-    finished = total - unfinished
+    unfinished,total = drain_queue(queues.jobs)
+    # (jobs still waiting to be retried had no host left to run them)
+    failed = sorted(drain_failed(queues.failed)+queues.abandon())
+    finished = total - unfinished - len(failed)
     logger.info("Finished %d/%d jobs" % (finished, total))
+    if queues.duplicates.value>0:
+        logger.info("Skipped %d duplicate jobs" % queues.duplicates.value)
+    for i,job in failed:
+        logger.error("Failed for good: job #%d: %s" % (i,job))
+    if queues.first_dispatch.value>0:
+        logger.info("First job dispatched %.3fs after start" % (queues.first_dispatch.value-starttime))
+    metrics.stop()
+    log_queue.put(None) # write out everything that is left
+    log_writer.join()
+    if pool is not None:
+        # the caller goes on, so leave nothing of this run behind
+        job_producer.join()
+        remove_queue_handlers(log_queue)
+        queues.close()
+        if journal is not None:
+            journal.close()
+        signal.signal(signal.SIGINT, signal.SIG_DFL if previous_sigint is None else previous_sigint)
+        return
     logging.shutdown()
     os.killpg(0, signal.SIGTERM) # kill everything dead
 
@@ -270,10 +1538,16 @@ def dummy_job_generator():
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("A script that iterates through a list of jobs provided by a generator and runs them")
-    parser.add_argument("-p","--pollint",default=1,help="How often should hosts be polled for output?")
-    parser.add_argument("hosts",help="hosts file with one machine name per line (a machine may be listed multiple times)")
+    parser.add_argument("-p","--pollint",default=1,type=float,help="Longest time to wait for host output before checking whether a job finished")
+    parser.add_argument("hosts",nargs='?',help="hosts file with one machine name per line, optionally as host:slots to run several jobs at once or host:slots:weight to also give its relative speed, used only when backing up jobs on slow hosts (a machine may be listed multiple times)")
     parser.add_argument("-o","--outdir",help="output directory")
+    parser.add_argument("-l","--local",nargs='?',const=0,type=int,help="run jobs on this machine instead of over ssh (optionally giving how many at once; one per core by default)")
+    parser.add_argument("-r","--resume",default=False,action='store_true',help="continue an earlier run into the same output directory, skipping jobs that already finished")
+    parser.add_argument("-c","--cache",help="directory of results of earlier jobs; jobs found there are not run again")
+    parser.add_argument("-d","--dedup",default=False,action='store_true',help="run identical jobs only once")
+    parser.add_argument("-b","--batch",type=float,help="run short jobs together in batches that take about this many seconds")
+    parser.add_argument("-s","--sessions",default=MAX_SESSIONS,type=int,help="most jobs to run over one ssh connection at once (sshd's MaxSessions)")
     parser.add_argument("-t","--test",default=False,action='store_true',help="do a dummy run (without contacting remotes or running jobs")
     args = parser.parse_args()
 
-    farm_jobs(dummy_job_generator(), args.hosts, args.pollint, args.outdir, args.test)
+    farm_jobs(dummy_job_generator(), args.hosts, args.pollint, args.outdir, args.test, resume=args.resume, local=args.local is not None, local_slots=args.local or None, cache=None if args.cache is None else ResultCache(args.cache), dedup=args.dedup, batch_seconds=args.batch, sessions_per_connection=args.sessions)